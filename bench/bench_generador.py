@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bench/bench_generador.py
+"""
+Banco de pruebas de rendimiento del generador, sin BD de producción.
+
+Genera datos sintéticos (depósitos, obras, equipamientos, cementerios y avisos)
+para N municipios, los sirve con una conexión falsa en memoria que contesta a
+las consultas de gen_forms.py y mide una generación completa con --profile
+(con --incremental, la segunda pasada, sin cambios en origen).
+Cada tamaño se ejecuta en un proceso aparte y el resultado se añade a
+bench/resultados.jsonl junto con el commit, para ver regresiones entre commits.
+
+    python bench/bench_generador.py                      # 140, 1000 y 5000 municipios
+    python bench/bench_generador.py -n 140 --args="--workers 4"
+    python bench/bench_generador.py -n 1000 --args=--incremental
+    python bench/bench_generador.py --comparar
+    python bench/bench_generador.py --snapshot .build/sintetico.json.gz -n 1000
+"""
+import os, sys, json, time, random, hashlib, shlex, argparse, subprocess, tempfile, shutil, contextlib, io, platform
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(BENCH_DIR)
+RESULTADOS_FILE = os.path.join(BENCH_DIR, "resultados.jsonl")
+TAMANOS = [140, 1000, 5000]
+
+# --- DATOS SINTÉTICOS ---
+FASE = 2025
+CATEGORIAS = [
+    ('CASA CONSISTORIAL', '316'), ('CENTRO CULTURAL', '321'), ('CENTRO ASISTENCIAL', '319'),
+    ('CENTRO ENSEÑANZA', '322'), ('CENTRO SANITARIO', '327'), ('EDIFICIO SIN USO', '328'),
+    ('INSTALACIÓN DEPORTIVA', '323'), ('MERCADO/LONJA', '324'), ('PARQUE', '331'),
+    ('PROTECCIÓN CIVIL', '325'), ('TANATORIO', '326'),
+]
+ESTADOS = {'B': 'Bueno', 'R': 'Regular', 'M': 'Malo', 'E': 'En ejecución', None: 'Desconocido'}
+TIPOS_AVISO = ['agua', 'obras', 'residuos', 'equipamientos', 'cementerios', 'alumbrado', 'viario', 'saneamiento']
+ARTICULOS = ['', '', '', ' (La)', ' (El)', ' (Els)', " (L')"]
+
+def municipios_sinteticos(n, seed=1):
+    """Lista con la misma forma que MUNICIPIOS_LISTA_UI (ordenada por nombre)."""
+    rnd = random.Random(seed)
+    ancho = max(3, len(str(n)))
+    lista = []
+    for i in range(1, n + 1):
+        nombre = f"Municipio {i:0{ancho}}{rnd.choice(ARTICULOS)}"
+        if rnd.random() < 0.05:
+            nombre += f"/Municipi {i:0{ancho}}"
+        lista.append({"code": f"{i:0{ancho}}", "name": nombre, "name_bonito": None})
+    lista.sort(key=lambda x: x["name"])
+    return lista
+
+def _num_equipamientos(rnd, atipico):
+    # La mayoría tiene pocas decenas; los atípicos, como equipamientos_014, más de 800
+    if atipico:
+        return rnd.randint(800, 1200)
+    return min(int(rnd.lognormvariate(2.5, 0.8)), 150)
+
+def generar_tablas(municipios, seed=1):
+    """
+    Filas con la forma que devuelve cada consulta de gen_forms.py (las columnas del
+    SELECT), por conjunto y ordenadas como en el ORDER BY. Alrededor de un municipio
+    de cada 140 es atípico en equipamientos.
+    """
+    rnd = random.Random(seed)
+    codigos = sorted(m["code"] for m in municipios)
+    atipicos = set(rnd.sample(codigos, max(1, len(codigos) // 140)))
+    tablas = {"depositos": [], "obras": [], "equipamientos": [], "cementerios": [], "avisos": [], "visor": []}
+    for mun in codigos:
+        for orden in range(1, rnd.randint(0, 6) + 1):
+            tablas["depositos"].append({"clave": "DE", "mun": mun, "orden_depo": f"{orden:03}",
+                                        "nombre": rnd.choice([f"DEPÓSITO {orden}", f"Dep. municipal nº {orden}", None]),
+                                        "limpieza": rnd.choice([1, 2, 3, None])})
+        for orden in range(1, rnd.randint(0, 15) + 1):
+            estado = rnd.choice(['EJ', 'AD', 'LI', 'FI', None])
+            tablas["obras"].append({"clave": "OB", "mun": mun, "orden": orden,
+                                    "nombre": f"Obra {orden} de mejora de la red & accesos <fase {FASE}>",
+                                    "plan_obra": rnd.choice([f"POS {FASE}", "PPOS", "DIPUTACIÓ", None]),
+                                    "estado": estado, "proyecto": rnd.choice(['PR', 'RE', None]),
+                                    "cond": 2 if estado == 'FI' else 0,
+                                    "link_licitacion": rnd.choice(["", f"https://contratacion.example/{mun}/{orden}", None])})
+        filas = []
+        for i in range(_num_equipamientos(rnd, mun in atipicos)):
+            tabla, capa = rnd.choice(CATEGORIAS)
+            estado = rnd.choice(list(ESTADOS))
+            idu = rnd.randint(1, 10 ** 6)
+            x, y = f"{rnd.uniform(-0.9, 0.2):.6f}", f"{rnd.uniform(37.9, 38.9):.6f}"
+            clave, geom_md5 = f"{capa}:{idu}", hashlib.md5(f"{x} {y}".encode()).hexdigest()
+            filas.append({"tabla": tabla, "mun": mun, "cod": f"EQ{mun}{i:04}",
+                          "nombre": f"{tabla.title()} {i} \"{mun}\" <&>", "estado": estado, "capa": capa, "idu": idu,
+                          "estado_txt": ESTADOS[estado],
+                          "url_foto": f"https://visoreiel.geonet.es/Manejadores/ObtenerMIME.ashx?entidad={capa}"
+                                      f"&atributo=foto&tipo=image/jpeg;jpg&identificador={idu}",
+                          "clave_visor": clave, "geom_md5": geom_md5})
+            # Centroides que devuelve la consulta de la caché del visor
+            tablas["visor"].append((clave, geom_md5, x, y))
+        tablas["equipamientos"].extend(sorted(filas, key=lambda r: r["cod"]))
+        for i in range(rnd.choice([0, 0, 1, 1, 1, 2, 3])):
+            tablas["cementerios"].append({"mun": mun, "nombre": rnd.choice([f"Cementerio {i + 1}", None])})
+        for tipo in TIPOS_AVISO:
+            for i in range(rnd.choice([0, 0, 0, 0, 0, 1, 1, 2])):
+                tablas["avisos"].append({"mun": mun, "tipo_formulario": tipo, "mensaje": f"Revisar datos de {tipo} ({i + 1})",
+                                         "prioridad": rnd.choice(["Alta", "Media", "Baja"]),
+                                         "url": rnd.choice(["", "www.example.es/ayuda", None])})
+    return tablas
+
+# --- CONEXIÓN FALSA (en memoria) ---
+# Reconoce cada consulta por su tabla principal y aplica solo el filtro de municipios.
+# Las huellas de --incremental (SQL_HUELLA) se calculan sobre las mismas filas.
+MARCA_HUELLA = "string_agg(md5(q::text)"
+CONSULTAS = [
+    ("any(%(claves)s)", "visor"),  # antes que casa_consistorial: también lleva la unión
+    ("geonet_fase", None),
+    ("solicitud_datos_formularios", "avisos"),
+    ("geonet_obras", "obras"),
+    ("deposito d", "depositos"),
+    ("casa_consistorial", "equipamientos"),
+    ("FROM cementerio", "cementerios"),
+]
+
+class CursorFalso:
+    def __init__(self, tablas, itersize=2000):
+        self.tablas = tablas
+        self.itersize = itersize
+        self.filas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        for marca, conjunto in CONSULTAS:
+            if marca in sql:
+                break
+        else:
+            raise NotImplementedError(f"Consulta no soportada por la conexión falsa:\n{sql}")
+        if conjunto is None:
+            self.filas = [(FASE,)]
+            return
+        if MARCA_HUELLA in sql:
+            self.filas = self._huellas(conjunto)
+            return
+        if conjunto == "visor":
+            claves = set(params["claves"])
+            self.filas = [r for r in self.tablas["visor"] if r[0] in claves]
+            return
+        muns = (params or {}).get("muns")
+        filas = self.tablas[conjunto]
+        if muns is not None:
+            muns = set(muns)
+            filas = [r for r in filas if r["mun"] in muns]
+        self.filas = filas
+
+    def _huellas(self, conjunto):
+        # (mun[, tipo_formulario], n, md5) como el GROUP BY de SQL_HUELLA
+        grupos = {}
+        for r in self.tablas[conjunto]:
+            clave = (r["mun"], r["tipo_formulario"]) if conjunto == "avisos" else (r["mun"],)
+            grupos.setdefault(clave, []).append(hashlib.md5(json.dumps(r, sort_keys=True).encode()).hexdigest())
+        return [(*clave, len(hashes), hashlib.md5("".join(sorted(hashes)).encode()).hexdigest())
+                for clave, hashes in sorted(grupos.items())]
+
+    def fetchone(self):
+        return self.filas[0] if self.filas else None
+
+    def fetchall(self):
+        return list(self.filas)
+
+    def __iter__(self):
+        return iter(self.filas)
+
+class ConexionFalsa:
+    def __init__(self, tablas):
+        self.tablas = tablas
+
+    def cursor(self, name=None, cursor_factory=None):
+        return CursorFalso(self.tablas)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def foto_sintetica(url):
+    """Descarga falsa para --miniaturas: un JPEG de 640×480 de un color por URL (una de cada 10, sin foto)."""
+    from PIL import Image  # solo con --miniaturas, que ya necesita Pillow
+    h = hashlib.md5(url.encode()).digest()
+    if h[0] % 10 == 0:
+        return None
+    salida = io.BytesIO()
+    Image.new("RGB", (640, 480), tuple(h[1:4])).save(salida, "JPEG", quality=85)
+    return salida.getvalue()
+
+# --- EJECUCIÓN DE UNA MEDIDA (proceso hijo) ---
+def _importar_generador(salida):
+    sys.path.insert(0, BASE_DIR)
+    with contextlib.redirect_stdout(salida):
+        import gen_forms
+    return gen_forms
+
+def _preparar(gen, n, seed, directorio):
+    """Redirige las salidas del generador a `directorio` y lo conecta a los datos sintéticos."""
+    municipios = municipios_sinteticos(n, seed)
+    for m in municipios:
+        m["name_bonito"] = gen.formatear_nombre_ui(m["name"])
+    gen._municipios["lista"] = municipios  # en vez de leer data/municipios.tsv
+    tablas = generar_tablas(municipios, seed)
+    gen.conectar = lambda: ConexionFalsa(tablas)
+    gen.OUTPUT_DIR = os.path.join(directorio, "docs")
+    gen.BUILD_DIR = os.path.join(directorio, ".build")
+    gen.MANIFEST_FILE = os.path.join(gen.BUILD_DIR, "manifest.json")
+    gen.CAMBIOS_FILE = os.path.join(gen.BUILD_DIR, "cambios.json")
+    gen.ESTADO_ORIGEN_FILE = os.path.join(gen.BUILD_DIR, "estado_origen.json")
+    gen.SHARDS_DIR = os.path.join(gen.BUILD_DIR, "shards")
+    gen.VISOR_CACHE_FILE = os.path.join(gen.BUILD_DIR, "visor-equipamientos.json")
+    gen.MINIATURAS_DIR = os.path.join(gen.BUILD_DIR, "miniaturas")
+    gen.MINIATURAS_INDICE = os.path.join(gen.MINIATURAS_DIR, "indice.json")
+    os.makedirs(gen.BUILD_DIR, exist_ok=True)
+    # --presupuesto sin fichero lee una copia de presupuestos.json del repo
+    presupuesto = os.path.join(directorio, "presupuestos.json")
+    if os.path.exists(gen.PRESUPUESTO_FILE):
+        shutil.copyfile(gen.PRESUPUESTO_FILE, presupuesto)
+    gen.PRESUPUESTO_FILE = presupuesto
+    return {conjunto: len(filas) for conjunto, filas in tablas.items() if conjunto != "visor"}
+
+def _pico_memoria_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def medir_una(n, seed, argumentos):
+    ruido = io.StringIO()
+    gen = _importar_generador(ruido)
+    directorio = tempfile.mkdtemp(prefix=f"eiel-bench-{n}-")
+    try:
+        filas = _preparar(gen, n, seed, directorio)
+        perfil = os.path.join(directorio, "perfil.json")
+        if "--incremental" in argumentos:
+            # Lo que interesa es la regeneración sin cambios: una primera pasada deja el
+            # estado de origen y se mide la segunda
+            with contextlib.redirect_stdout(ruido):
+                gen.main(argumentos, descargar=foto_sintetica)
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(ruido):
+            gen.main(argumentos + ["--profile", perfil], descargar=foto_sintetica)
+        total = time.perf_counter() - t0
+        if not os.path.exists(perfil):
+            # main() informa de los errores por pantalla en vez de lanzarlos
+            raise RuntimeError("la generación ha fallado:\n" + ruido.getvalue()[-2000:])
+        with open(perfil, encoding="utf-8") as f:
+            informe = json.load(f)
+        paginas = [e for e in os.scandir(gen.OUTPUT_DIR) if e.name.endswith(".html")]
+        return {
+            "municipios": n,
+            "filas": filas,
+            "segundos": round(total, 3),
+            "etapas": informe["etapas"],
+            "paginas": len(paginas),
+            "bytes_html": sum(e.stat().st_size for e in paginas),
+            "pico_memoria_mb": _pico_memoria_mb(),
+        }
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+# --- RESULTADOS ---
+def _git(*args):
+    try:
+        return subprocess.run(["git", *args], cwd=BASE_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def version_actual():
+    commit = _git("rev-parse", "--short", "HEAD")
+    if commit and _git("status", "--porcelain", "--untracked-files=no", "--", "gen_forms.py", "templates"):
+        commit += "+cambios"
+    return commit
+
+def leer_resultados(ruta=RESULTADOS_FILE):
+    if not os.path.exists(ruta):
+        return []
+    with open(ruta, encoding="utf-8") as f:
+        return [json.loads(linea) for linea in f if linea.strip()]
+
+def comparar(resultados, umbral=10.0):
+    """
+    Para cada (municipios, modo), compara la última medida con la del commit anterior
+    medido. Devuelve cuántas empeoran más de `umbral` %.
+    """
+    regresiones = 0
+    grupos = {}
+    for r in resultados:
+        grupos.setdefault((r["municipios"], r["modo"]), []).append(r)
+    for (n, modo), lista in sorted(grupos.items()):
+        ultimo = lista[-1]
+        previos = [r for r in lista if r["commit"] != ultimo["commit"]]
+        linea = f"   {n:>6} mun.  {modo or '(serie)':<22} {ultimo['commit'] or '?':<16} {ultimo['segundos']:8.2f} s"
+        if previos:
+            antes = previos[-1]
+            cambio = (ultimo["segundos"] - antes["segundos"]) / antes["segundos"] * 100 if antes["segundos"] else 0.0
+            marca = "  ⚠️ regresión" if cambio > umbral else ""
+            regresiones += cambio > umbral
+            linea += f"  vs {antes['commit']}: {antes['segundos']:8.2f} s ({cambio:+.1f}%){marca}"
+        print(linea)
+    return regresiones
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de pruebas del generador con datos sintéticos (sin BD).")
+    parser.add_argument("-n", "--municipios", type=int, action="append",
+                        help=f"Tamaños a medir (repetible; por defecto {', '.join(map(str, TAMANOS))}).")
+    parser.add_argument("--args", default="", help='Argumentos para gen_forms.py, p. ej. --args="--workers 4" o --args=--pipeline.')
+    parser.add_argument("--seed", type=int, default=1, help="Semilla de los datos sintéticos (por defecto 1).")
+    parser.add_argument("--repeticiones", type=int, default=1, help="Medidas por tamaño (por defecto 1).")
+    parser.add_argument("--resultados", default=RESULTADOS_FILE, help="Fichero JSONL donde se acumulan los resultados.")
+    parser.add_argument("--comparar", action="store_true", help="Solo compara los resultados guardados entre commits.")
+    parser.add_argument("--umbral", type=float, default=10.0,
+                        help="%% de empeoramiento que cuenta como regresión en --comparar (por defecto 10).")
+    parser.add_argument("--snapshot", metavar="FICHERO",
+                        help="En vez de medir, guarda los datos sintéticos como instantánea para --from-snapshot.")
+    parser.add_argument("--una", type=int, help=argparse.SUPPRESS)  # uso interno: una medida en este proceso
+    args = parser.parse_args(argv)
+    argumentos = shlex.split(args.args)
+
+    if args.una is not None:
+        print(json.dumps(medir_una(args.una, args.seed, argumentos), ensure_ascii=False))
+        return 0
+
+    if args.comparar:
+        return 1 if comparar(leer_resultados(args.resultados), args.umbral) else 0
+
+    if args.snapshot:
+        gen = _importar_generador(io.StringIO())
+        n = (args.municipios or TAMANOS[:1])[0]
+        with tempfile.TemporaryDirectory() as directorio:
+            _preparar(gen, n, args.seed, directorio)
+            datos = gen.cargar_datos(gen.conectar(), informar=False)
+        gen.exportar_snapshot(datos, args.snapshot)
+        print(f" Instantánea sintética de {n} municipios guardada en {args.snapshot} "
+              f"(generar con la lista sintética: los códigos no coinciden con data/municipios.tsv).")
+        return 0
+
+    commit = version_actual()
+    for n in args.municipios or TAMANOS:
+        for _ in range(args.repeticiones):
+            print(f" Midiendo {n} municipios{' con ' + args.args if args.args else ''}...", flush=True)
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--una", str(n),
+                                   "--seed", str(args.seed), f"--args={args.args}"],
+                                  capture_output=True, text=True, encoding="utf-8")
+            if proc.returncode != 0:
+                print(f"❌ ERROR midiendo {n} municipios:\n{proc.stderr or proc.stdout}")
+                return 1
+            medida = json.loads(proc.stdout.strip().splitlines()[-1])
+            resultado = {"commit": commit, "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"), "modo": args.args,
+                         "seed": args.seed, "python": platform.python_version(), **medida}
+            with open(args.resultados, "a", encoding="utf-8") as f:
+                f.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+            etapas = ", ".join(f"{e} {s:.2f} s" for e, s in resultado["etapas"].items())
+            print(f"   {resultado['segundos']:.2f} s, {resultado['paginas']} páginas, "
+                  f"{resultado['bytes_html'] / 1024 / 1024:.1f} MiB"
+                  + (f", pico {resultado['pico_memoria_mb']} MiB" if resultado["pico_memoria_mb"] else "")
+                  + f" ({etapas})")
+    print(f"\n Resultados en {args.resultados}:")
+    comparar(leer_resultados(args.resultados), args.umbral)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # gen_forms.py
-import os, json, sys, csv, shutil
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+import os, json, sys, csv, shutil, hashlib, argparse, filecmp
+import concurrent.futures, queue, threading, time, itertools, gzip, contextlib
+import collections, mimetypes, urllib.parse, unicodedata
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateSyntaxError, meta, select_autoescape
 from dotenv import load_dotenv
 import psycopg2
 import psycopg2.extras
 import re
-import base64
 from io import BytesIO
-from PIL import Image
 
-load_dotenv()
+# Importar este módulo no lee .env, ni el TSV, ni compila plantillas: todo se
+# carga al primer uso (configuracion(), municipios_ui(), cargar_plantilla()).
 
 # --- FUNCIÓN PARA FORMATEAR NOMBRES DE MUNICIPIOS ---
 def formatear_nombre_ui(nombre_original):
@@ -55,87 +56,174 @@ TEMPLATE_VIARIO = "form-viario.html.j2"
 TEMPLATE_ALUMBRADO = "form-alumbrado.html.j2"
 TEMPLATE_SANEAMIENTO = "form-saneamiento.html.j2"
 
-# --- PARAMETROS DB ---
-DB = {
-    "host": os.getenv("DB_HOST"), 
-    "port": os.getenv("DB_PORT"), 
-    "dbname": os.getenv("DB_NAME"),
-    "user": os.getenv("DB_USER"), 
-    "password": os.getenv("DB_PASSWORD")
-}
+# --- CONFIGURACIÓN (.env): PARÁMETROS DB Y URLs (Apps Script + Worker de adjuntos) ---
+_config = {}
 
-# --- URLs (Apps Script + Worker de adjuntos) ---
-URL_ADJUNTOS = os.getenv("URL_ADJUNTOS")
-URL_ADJUNTOS_WORKER = os.getenv(
-    "URL_ADJUNTOS_WORKER",
-    "https://eiel-adjuntos.cguillen-4b9.workers.dev",
-)
-URL_GENERAR_PDF = os.getenv("URL_GENERAR_PDF")
-URL_LOGIN_SCRIPT = os.getenv("URL_LOGIN_SCRIPT")
-URL_LOGGER = os.getenv("URL_LOGGER")
+def configuracion():
+    """Lee .env y el entorno la primera vez que se pide; después devuelve lo ya leído."""
+    if not _config:
+        load_dotenv()
+        _config.update({
+            "db": {
+                "host": os.getenv("DB_HOST"), 
+                "port": os.getenv("DB_PORT"), 
+                "dbname": os.getenv("DB_NAME"),
+                "user": os.getenv("DB_USER"), 
+                "password": os.getenv("DB_PASSWORD")
+            },
+            "url_adjuntos": os.getenv("URL_ADJUNTOS"),
+            "url_adjuntos_worker": os.getenv(
+                "URL_ADJUNTOS_WORKER",
+                "https://eiel-adjuntos.cguillen-4b9.workers.dev",
+            ),
+            "url_generar_pdf": os.getenv("URL_GENERAR_PDF"),
+            "url_login_script": os.getenv("URL_LOGIN_SCRIPT"),
+            "url_logger": os.getenv("URL_LOGGER"),
+            # Plantilla opcional de la URL de descarga de fotos ({capa}, {idu}) para --miniaturas
+            "url_fotos_equip": os.getenv("URL_FOTOS_EQUIP"),
+            "serve_token": os.getenv("SERVE_TOKEN"),
+        })
+    return _config
 
 
 # --- CARGA DE LISTA DE MUNICIPIOS (DESDE TSV) ---
+_municipios = {}
 
-MUNICIPIOS_LISTA_UI = [] # Para rellenar el combo del login
+def cargar_municipios(ruta=MUNICIPIOS_FILE):
+    lista = [] # Para rellenar el combo del login
+    try:
+        if os.path.exists(ruta):
+            with open(ruta, "r", encoding="utf-8") as f:
+                # Leemos el TSV con delimitador de tabulación
+                reader = csv.reader(f, delimiter='\t')
+                
+                print(f"Cargando lista de municipios desde: {ruta}")
+                for row in reader:
+                    # Aseguramos que la fila tenga al menos Código y Nombre
+                    if len(row) >= 2:
+                        code = row[0].strip()
+                        name = row[1].strip()
+                        
+                        # Saltar la cabecera si existe
+                        if code.lower() in ["codigo", "code", "id", "cod_ine", "ine"]:
+                            continue
+                        
+                        # Calculamos el nombre bonito al cargar (nombre con el artículo delante)
+                        name_bonito = formatear_nombre_ui(name)
 
-try:
-    if os.path.exists(MUNICIPIOS_FILE):
-        with open(MUNICIPIOS_FILE, "r", encoding="utf-8") as f:
-            # Leemos el TSV con delimitador de tabulación
-            reader = csv.reader(f, delimiter='\t')
-            
-            print(f"Cargando lista de municipios desde: {MUNICIPIOS_FILE}")
-            for row in reader:
-                # Aseguramos que la fila tenga al menos Código y Nombre
-                if len(row) >= 2:
-                    code = row[0].strip()
-                    name = row[1].strip()
-                    
-                    # Saltar la cabecera si existe
-                    if code.lower() in ["codigo", "code", "id", "cod_ine", "ine"]:
-                        continue
-                    
-                    # Calculamos el nombre bonito al cargar (nombre con el artículo delante)
-                    name_bonito = formatear_nombre_ui(name)
-
-                    MUNICIPIOS_LISTA_UI.append({
-                        "code": code, 
-                        "name": name,              # Nombre original (para Login/Combo)
-                        "name_bonito": name_bonito # Nombre bonito (para Títulos/Formularios)
-                    })
-            
-        # Ordenar lista por nombre original para el combo
-        MUNICIPIOS_LISTA_UI.sort(key=lambda x: x["name"])
-        print(f" {len(MUNICIPIOS_LISTA_UI)} municipios cargados.")
-    else:
-        print(f"⚠️ AVISO: No se encuentra el archivo en {MUNICIPIOS_FILE}.")
+                        lista.append({
+                            "code": code, 
+                            "name": name,              # Nombre original (para Login/Combo)
+                            "name_bonito": name_bonito # Nombre bonito (para Títulos/Formularios)
+                        })
+                
+            # Ordenar lista por nombre original para el combo
+            lista.sort(key=lambda x: x["name"])
+            print(f" {len(lista)} municipios cargados.")
+        else:
+            print(f"⚠️ AVISO: No se encuentra el archivo en {ruta}.")
+
+    except Exception as e:
+        print(f"❌ ERROR procesando lista de municipios: {e}")
+    return lista
+
+def municipios_ui():
+    """Lista de municipios del TSV (se lee una vez, al primer uso)."""
+    if "lista" not in _municipios:
+        _municipios["lista"] = cargar_municipios()
+    return _municipios["lista"]
+
+
+# --- ASSETS CON HUELLA EN EL NOMBRE ---
+# Las páginas enlazan css/style.<hash>.css en vez de style.css?v=...: el nombre cambia
+# solo cuando cambia el contenido, así que el navegador puede cachearlos para siempre.
+DIRS_ASSETS = {"css": ASSETS_CSS_DIR, "assets": ASSETS_DIR, "js": ASSETS_JS_DIR}
+PATRON_ASSET_HUELLA = re.compile(r"^(.+)\.([0-9a-f]{10})(\.[^./]+)$")
+_assets = {}
 
-except Exception as e:
-    print(f"❌ ERROR procesando lista de municipios: {e}")
+def mapa_assets():
+    """{"css/style.css": {"origen": ruta, "huella": "css/style.1a2b3c4d5e.css"}}, calculado una vez."""
+    if not _assets:
+        for carpeta, origen in DIRS_ASSETS.items():
+            if not os.path.isdir(origen): continue
+            for raiz, _, ficheros in os.walk(origen):
+                for nombre in sorted(ficheros):
+                    actualizar_asset(carpeta, os.path.join(raiz, nombre))
+    return _assets
+
+def actualizar_asset(carpeta, ruta):
+    # (Re)calcula la huella de un fichero de css/assets/js; si ya no existe, lo quita del mapa
+    rel = "/".join([carpeta] + os.path.relpath(ruta, DIRS_ASSETS[carpeta]).split(os.sep))
+    if not os.path.isfile(ruta):
+        _assets.pop(rel, None)
+        return rel
+    with open(ruta, "rb") as f:
+        h = hashlib.sha256(f.read()).hexdigest()[:10]
+    base, ext = os.path.splitext(rel)
+    _assets[rel] = {"origen": ruta, "huella": f"{base}.{h}{ext}"}
+    return rel
+
+def asset(ruta):
+    # Global de plantilla: {{ asset('css/style.css') }}
+    entrada = mapa_assets().get(ruta)
+    return entrada["huella"] if entrada else ruta
 
 
 # --- CONFIGURAR JINJA2 ---
-env = Environment(
-    loader=FileSystemLoader(TEMPLATE_DIR, encoding="utf-8"),
-    autoescape=select_autoescape(['html','xml'])
-)
-env.filters['fromjson'] = lambda v: json.loads(v) if v else None
-    
+# El entorno se crea al primer render y cada plantilla se compila la primera vez que
+# se pide. El código compilado se guarda en .build/jinja (FileSystemBytecodeCache):
+# en la siguiente ejecución solo se recompilan las plantillas que han cambiado.
+_jinja = {}
+
+def entorno_jinja():
+    if "env" not in _jinja:
+        cache = os.path.join(BUILD_DIR, "jinja")
+        os.makedirs(cache, exist_ok=True)
+        env = Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR, encoding="utf-8"),
+            autoescape=select_autoescape(['html','xml']),
+            bytecode_cache=FileSystemBytecodeCache(cache)
+        )
+        env.filters['fromjson'] = lambda v: json.loads(v) if v else None
+        env.globals['asset'] = asset
+        _jinja["env"] = env
+    return _jinja["env"]
+
 # --- CARGAR PLANTILLAS ---
-template_index = env.get_template(TEMPLATE_INDEX)
-template_agua = env.get_template(TEMPLATE_AGUA)
-template_obras = env.get_template(TEMPLATE_OBRAS)
-template_residuos = env.get_template(TEMPLATE_RESIDUOS)
-template_cementerios = env.get_template(TEMPLATE_CEMENTERIOS)
-template_equipamientos = env.get_template(TEMPLATE_EQUIPAMIENTOS)
-template_viario = env.get_template(TEMPLATE_VIARIO)
-template_alumbrado = env.get_template(TEMPLATE_ALUMBRADO)
-template_saneamiento = env.get_template(TEMPLATE_SANEAMIENTO)
+def cargar_plantilla(nombre):
+    return entorno_jinja().get_template(nombre)
+
+def plantilla_datos():
+    # Ficheros de datos (JSON) que acompañan a una página: pasan por el mismo escribir() que las plantillas
+    if "datos" not in _jinja:
+        _jinja["datos"] = entorno_jinja().from_string("{{ contenido | safe }}")
+    return _jinja["datos"]
+
+# Compatibilidad: gen_forms.MUNICIPIOS_LISTA_UI, .DB, .URL_*, .template_* siguen existiendo,
+# pero se calculan al pedirlos (PEP 562) en vez de al importar.
+_GLOBALES_DIFERIDOS = {
+    "DB": lambda: configuracion()["db"],
+    "URL_ADJUNTOS": lambda: configuracion()["url_adjuntos"],
+    "URL_ADJUNTOS_WORKER": lambda: configuracion()["url_adjuntos_worker"],
+    "URL_GENERAR_PDF": lambda: configuracion()["url_generar_pdf"],
+    "URL_LOGIN_SCRIPT": lambda: configuracion()["url_login_script"],
+    "URL_LOGGER": lambda: configuracion()["url_logger"],
+    "URL_FOTOS_EQUIP": lambda: configuracion()["url_fotos_equip"],
+    "MUNICIPIOS_LISTA_UI": municipios_ui,
+    "template_datos": plantilla_datos,
+}
+
+def __getattr__(nombre):
+    if nombre in _GLOBALES_DIFERIDOS:
+        return _GLOBALES_DIFERIDOS[nombre]()
+    if nombre.startswith("template_") and f"TEMPLATE_{nombre[9:].upper()}" in globals():
+        return cargar_plantilla(globals()[f"TEMPLATE_{nombre[9:].upper()}"])
+    raise AttributeError(f"module {__name__!r} has no attribute {nombre!r}")
 
 # --- CONEXIÓN A BASE DE DATOS ---
 def conectar():
-    return psycopg2.connect(host=DB["host"], port=DB["port"], dbname=DB["dbname"], user=DB["user"], password=DB["password"])
+    db = configuracion()["db"]
+    return psycopg2.connect(host=db["host"], port=db["port"], dbname=db["dbname"], user=db["user"], password=db["password"])
 
 
 def obtener_fase_actual(conn):
@@ -146,334 +234,2440 @@ def obtener_fase_actual(conn):
             return int(row[0])
         return 2024 # Fallback por si la tabla está vacía
 
-def obtener_depositos(conn, mun):
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        sql = """
-        SELECT d.clave, d.mun, d.orden_depo, d.nombre, de.limpieza 
-        FROM deposito d LEFT JOIN deposito_enc de USING (fase, mun, orden_depo) 
-        WHERE d.fase = (SELECT max(fase) FROM geonet_fase) 
-            AND d.mun = %s 
-            AND de.titular  = 'MU'
-        ORDER BY d.orden_depo;
-        """
-        cur.execute(sql, (mun,))
-        return [{
-            "codigo": f"{r['clave']}{r['mun']}{r['orden_depo']}",
-            "nombre": r["nombre"] or "", 
-            "limpieza": str(r["limpieza"]) if r["limpieza"] else ""
-        } for r in cur.fetchall()]
+# --- PERFIL DE LA GENERACIÓN (--profile) ---
+# Medidas por (municipio, formulario/conjunto, etapa): query, transform, render, write.
+# Solo se anota si se ha llamado a iniciar_perfil(); "*" = todos los municipios.
+_perfil = None
+_perfil_lock = threading.Lock()
 
-def obtener_obras(conn, mun):
+def iniciar_perfil():
+    global _perfil
+    _perfil = {"medidas": [], "consultas": []}
+
+def registrar_medida(mun, form, etapa, segundos, filas=None, bytes=None):
+    if _perfil is None:
+        return
+    with _perfil_lock:
+        _perfil["medidas"].append({"mun": mun, "form": form, "etapa": etapa, "segundos": round(segundos, 6),
+                                   "filas": filas, "bytes": bytes})
+
+@contextlib.contextmanager
+def medir(mun, form, etapa, filas=None):
+    medida = {"filas": filas, "bytes": None}
+    t0 = time.perf_counter()
+    try:
+        yield medida
+    finally:
+        registrar_medida(mun, form, etapa, time.perf_counter() - t0, medida["filas"], medida["bytes"])
+
+def _etiqueta_muns(params):
+    muns = params.get("muns")
+    return muns[0] if muns and len(muns) == 1 else "*"
+
+def _consultar(cur, conjunto, sql, params):
+    # execute + fetchall anotando tiempo, filas y la consulta (para --explain)
+    t0 = time.perf_counter()
+    cur.execute(sql, params)
+    filas = cur.fetchall()
+    segundos = time.perf_counter() - t0
+    if _perfil is not None:
+        registrar_medida(_etiqueta_muns(params), conjunto, "query", segundos, filas=len(filas))
+        with _perfil_lock:
+            _perfil["consultas"].append({"conjunto": conjunto, "sql": sql, "params": params,
+                                         "segundos": round(segundos, 6), "filas": len(filas)})
+    return filas
+
+def _clave_pagina(nombre):
+    # "agua_014.html" y sus datos "data/equipamientos_014/parque.json" -> ("014", form)
+    m = re.match(r"^(?:data/)?([a-z]+)_(\w+)(?:\.html|/.+)$", nombre)
+    return (m.group(2), m.group(1)) if m else ("*", nombre.rsplit(".", 1)[0])
+
+def capturar_explain(conn):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) de la consulta más lenta de cada conjunto. Ojo: ANALYZE
+    vuelve a ejecutarla.
+    """
+    lentas = {}
+    for c in _perfil["consultas"]:
+        if c["conjunto"] not in lentas or c["segundos"] > lentas[c["conjunto"]]["segundos"]:
+            lentas[c["conjunto"]] = c
+    planes = {}
+    with conn.cursor() as cur:
+        for conjunto, c in sorted(lentas.items()):
+            cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + c["sql"], c["params"])
+            planes[conjunto] = {"segundos": c["segundos"], "plan": "\n".join(r[0] for r in cur.fetchall())}
+    conn.rollback()
+    return planes
+
+def informe_perfil(ruta, total, top=10, planes=None):
+    """
+    Guarda el perfil en JSON e imprime los municipios, consultas y plantillas más lentos.
+    """
+    medidas = _perfil["medidas"]
+    etapas = {}
+    for m in medidas:
+        etapas[m["etapa"]] = etapas.get(m["etapa"], 0.0) + m["segundos"]
+
+    por_mun = {}
+    for m in medidas:
+        if m["mun"] != "*" and m["etapa"] in ("render", "write"):
+            d = por_mun.setdefault(m["mun"], {"segundos": 0.0, "bytes": 0})
+            d["segundos"] += m["segundos"]
+            d["bytes"] += m["bytes"] or 0
+    por_plantilla = {}
+    for m in medidas:
+        if m["etapa"] == "render":
+            d = por_plantilla.setdefault(m["form"], {"segundos": 0.0, "paginas": 0, "max_segundos": 0.0})
+            d["segundos"] += m["segundos"]
+            d["paginas"] += 1
+            d["max_segundos"] = max(d["max_segundos"], m["segundos"])
+
+    informe = {
+        "total_segundos": round(total, 3),
+        "etapas": {k: round(v, 3) for k, v in etapas.items()},
+        "municipios": {k: {"segundos": round(v["segundos"], 4), "bytes": v["bytes"]} for k, v in sorted(por_mun.items())},
+        "plantillas": {k: {kk: round(vv, 4) if isinstance(vv, float) else vv for kk, vv in v.items()}
+                       for k, v in sorted(por_plantilla.items())},
+        "consultas": [{k: v for k, v in c.items() if k != "params"} | {"municipios": _etiqueta_muns(c["params"])}
+                      for c in sorted(_perfil["consultas"], key=lambda c: -c["segundos"])],
+        "medidas": medidas,
+    }
+    if planes:
+        informe["explain"] = planes
+    os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(informe, f, ensure_ascii=False, indent=1)
+
+    print(f"\n Perfil ({total:.1f} s) guardado en {ruta}")
+    print("   Etapas: " + ", ".join(f"{k} {v:.2f} s" for k, v in sorted(etapas.items(), key=lambda kv: -kv[1])))
+    print("   Municipios más lentos (render + escritura):")
+    for mun, d in sorted(por_mun.items(), key=lambda kv: -kv[1]["segundos"])[:top]:
+        print(f"     {mun}  {d['segundos']:7.3f} s  {d['bytes'] / 1024:8.0f} KiB")
+    if informe["consultas"]:
+        print("   Consultas más lentas:")
+    for c in informe["consultas"][:top]:
+        print(f"     {c['conjunto']:<24} {c['segundos']:7.3f} s  {c['filas']:7} filas  ({c['municipios']})")
+    print("   Plantillas más lentas (total / máx. por página):")
+    for form, d in sorted(por_plantilla.items(), key=lambda kv: -kv[1]["segundos"])[:top]:
+        print(f"     {form:<14} {d['segundos']:7.3f} s / {d['max_segundos']:6.3f} s  ({d['paginas']} páginas)")
+    return informe
+
+# --- PRESUPUESTOS DE PESO Y TIEMPO (--presupuesto) ---
+# Límites en un JSON (por defecto presupuestos.json) que se comprueban al terminar con lo
+# que ya se tiene: los bytes del manifiesto y las filas y segundos del perfil. Los límites
+# por página van por formulario, con "*" para el resto. Las claves "_..." son comentarios.
+PRESUPUESTO_FILE = os.path.join(BASE_DIR, "presupuestos.json")
+CLAVES_PRESUPUESTO = {
+    "bytes_pagina": dict,       # {form: bytes de cada página .html}
+    "filas_pagina": dict,       # {form: filas de datos de cada página renderizada}
+    "bytes_docs": "limite",     # bytes de todo docs/
+    "segundos_etapa": dict,     # {etapa: segundos sumados (query, transform, render, write)}
+    "segundos_total": "limite", # segundos de la generación
+}
+
+def cargar_presupuesto(ruta):
+    with open(ruta, "r", encoding="utf-8") as f:
+        presupuesto = json.load(f)
+    if not isinstance(presupuesto, dict):
+        raise ValueError(f"{ruta}: se espera un objeto JSON")
+    presupuesto = {k: v for k, v in presupuesto.items() if not k.startswith("_")}
+    for clave, valor in presupuesto.items():
+        tipo = CLAVES_PRESUPUESTO.get(clave)
+        if tipo is None:
+            raise ValueError(f"{ruta}: clave desconocida {clave!r} (válidas: {', '.join(CLAVES_PRESUPUESTO)})")
+        if tipo is dict and not (isinstance(valor, dict) and all(map(_limite_valido, valor.values()))):
+            raise ValueError(f"{ruta}: {clave!r} debe ser un objeto de límites positivos")
+        if tipo == "limite" and not _limite_valido(valor):
+            raise ValueError(f"{ruta}: {clave!r} debe ser un límite positivo")
+    return presupuesto
+
+def _limite_valido(valor):
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool) and valor > 0
+
+def _tamano_carpeta(carpeta):
+    total = 0
+    for raiz, _, ficheros in os.walk(carpeta):
+        for nombre in ficheros:
+            total += os.path.getsize(os.path.join(raiz, nombre))
+    return total
+
+def comprobar_presupuesto(presupuesto, ficheros, total_segundos):
+    """
+    Compara la salida (`ficheros`: manifiesto {nombre: {"bytes", ...}}), las medidas del
+    perfil y la duración con el presupuesto. Devuelve los incumplimientos, del mayor
+    exceso (valor / límite) al menor.
+    """
+    fuera = []
+    def anotar(tipo, objeto, valor, limite):
+        if limite is not None and valor > limite:
+            fuera.append({"tipo": tipo, "objeto": objeto, "valor": valor, "limite": limite,
+                          "exceso": round(valor / limite, 2)})
+
+    limites = presupuesto.get("bytes_pagina", {})
+    for nombre, entrada in ficheros.items():
+        if nombre.endswith(".html"):
+            form = _clave_pagina(nombre)[1]
+            anotar("bytes_pagina", nombre, entrada["bytes"], limites.get(form, limites.get("*")))
+    etapas = {}
+    filas = {}
+    for m in _perfil["medidas"] if _perfil is not None else []:
+        etapas[m["etapa"]] = etapas.get(m["etapa"], 0.0) + m["segundos"]
+        if m["etapa"] == "render" and m["filas"] is not None and m["mun"] != "*":
+            # Una entrada por página aunque haya varias medidas de render
+            filas[(m["form"], m["mun"])] = max(m["filas"], filas.get((m["form"], m["mun"]), 0))
+    limites = presupuesto.get("filas_pagina", {})
+    for (form, mun), n in sorted(filas.items()):
+        anotar("filas_pagina", f"{form}_{mun}.html", n, limites.get(form, limites.get("*")))
+    if "bytes_docs" in presupuesto:
+        anotar("bytes_docs", "docs/", _tamano_carpeta(OUTPUT_DIR), presupuesto["bytes_docs"])
+    for etapa, limite in presupuesto.get("segundos_etapa", {}).items():
+        anotar("segundos_etapa", etapa, round(etapas.get(etapa, 0.0), 3), limite)
+    if "segundos_total" in presupuesto:
+        anotar("segundos_total", "generación", round(total_segundos, 3), presupuesto["segundos_total"])
+    return sorted(fuera, key=lambda i: -i["exceso"])
+
+def _formato_medida(tipo, valor):
+    if tipo.startswith("bytes"):
+        return f"{valor / 1024 / 1024:.2f} MB" if valor >= 1024 * 1024 else f"{valor / 1024:.0f} KB"
+    if tipo.startswith("segundos"):
+        return f"{valor:.1f} s"
+    return f"{valor} filas"
+
+def informe_presupuesto(ruta, incumplimientos, top=20):
+    nombre = os.path.relpath(ruta, BASE_DIR) if ruta == PRESUPUESTO_FILE else ruta
+    if not incumplimientos:
+        print(f"\n Presupuesto ({nombre}): todo dentro de los límites.")
+        return
+    print(f"\n ⚠️ Presupuesto ({nombre}): {len(incumplimientos)} incumplimientos, de mayor a menor exceso:")
+    for i in incumplimientos[:top]:
+        print(f"   {i['objeto']:<28} {i['tipo']:<15} {_formato_medida(i['tipo'], i['valor']):>12} "
+              f"/ {_formato_medida(i['tipo'], i['limite'])}  (x{i['exceso']:.2f})")
+    if len(incumplimientos) > top:
+        print(f"   ... y {len(incumplimientos) - top} más.")
+
+def _filtro_mun(columna, municipios):
+    # Sin lista de municipios se cargan todos los de la fase
+    if municipios is None:
+        return ""
+    return f"AND {columna} = ANY(%(muns)s)"
+
+def _params(fase, municipios):
+    return {"fase": fase, "muns": list(municipios) if municipios is not None else None}
+
+# --- CARGA MASIVA (UNA CONSULTA POR CONJUNTO DE DATOS PARA TODOS LOS MUNICIPIOS) ---
+SQL_DEPOSITOS = """
+    SELECT d.clave, d.mun, d.orden_depo, d.nombre, de.limpieza 
+    FROM deposito d LEFT JOIN deposito_enc de USING (fase, mun, orden_depo) 
+    WHERE d.fase = %(fase)s
+        AND de.titular  = 'MU'
+        {filtro_mun}
+    ORDER BY d.mun, d.orden_depo;
+"""
+
+def cargar_depositos(conn, fase, municipios=None):
     with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        sql = """
-                SELECT o.clave, o.mun, o.orden, o.nombre, o.plan_obra, o.estado, o.proyecto,
-                CASE WHEN o.estado = 'FI' THEN 2 ELSE 0 END as cond,
-                lic.link_licitacion
-                FROM geonet_obras o
-                LEFT JOIN coordinador.licitaciones lic ON lic.identificador = o.id_contratacion
-                WHERE o.fase = (SELECT max(fase) FROM geonet_fase)
-                AND o.mun = %s
-                AND (
-                    (o.equipamientos IS NULL OR o.equipamientos = 'SI') OR
-                    (o.alumbrado IS NULL OR o.alumbrado = 'SI') OR
-                    (o.infra_viaria IS NULL OR o.infra_viaria = 'SI') OR
-                    (o.abastecimiento IS NULL OR o.abastecimiento = 'SI') OR
-                    (o.saneamiento IS NULL OR o.saneamiento = 'SI')
-                ) 
-                -- Se descartan las anuladas
-                AND (o.estado IS NULL OR o.estado <> 'AN') 
-                -- Se descartan las finalizadas con proyecto
-                AND NOT (o.estado IS NOT DISTINCT FROM 'FI' AND o.proyecto IS NOT DISTINCT FROM 'RE')
-                -- Se descartan las obras de EATIMS (ELM), que se piden por otro canal (email o similar)
-                AND NOT (
-                    (o.mun = '063' AND o.nombre ILIKE ANY(ARRAY['%%JESÚS POBRE%%','%%JESUS POBRE%%','%%LA XARA%%','%%LA JARA%%']))
-                    OR
-                    (o.mun = '006' AND o.nombre ILIKE ANY(ARRAY['%%LLOSA DE CAMACHO%%','%%LLOSA DE CAMATXO%%']))
+        filas = _consultar(cur, "depositos", SQL_DEPOSITOS.format(filtro_mun=_filtro_mun("d.mun", municipios)), _params(fase, municipios))
+        indice = {}
+        with medir("*", "depositos", "transform", len(filas)):
+            for r in filas:
+                indice.setdefault(r["mun"], []).append({
+                    "codigo": f"{r['clave']}{r['mun']}{r['orden_depo']}",
+                    "nombre": r["nombre"] or "", 
+                    "limpieza": str(r["limpieza"]) if r["limpieza"] else ""
+                })
+        return indice
+
+SQL_OBRAS = """
+        SELECT o.clave, o.mun, o.orden, o.nombre, o.plan_obra, o.estado, o.proyecto,
+        CASE WHEN o.estado = 'FI' THEN 2 ELSE 0 END as cond,
+        lic.link_licitacion
+        FROM geonet_obras o
+        LEFT JOIN coordinador.licitaciones lic ON lic.identificador = o.id_contratacion
+        WHERE o.fase = %(fase)s
+        {filtro_mun}
+        AND (
+            (o.equipamientos IS NULL OR o.equipamientos = 'SI') OR
+            (o.alumbrado IS NULL OR o.alumbrado = 'SI') OR
+            (o.infra_viaria IS NULL OR o.infra_viaria = 'SI') OR
+            (o.abastecimiento IS NULL OR o.abastecimiento = 'SI') OR
+            (o.saneamiento IS NULL OR o.saneamiento = 'SI')
+        ) 
+        -- Se descartan las anuladas
+        AND (o.estado IS NULL OR o.estado <> 'AN') 
+        -- Se descartan las finalizadas con proyecto
+        AND NOT (o.estado IS NOT DISTINCT FROM 'FI' AND o.proyecto IS NOT DISTINCT FROM 'RE')
+        -- Se descartan las obras de EATIMS (ELM), que se piden por otro canal (email o similar)
+        AND NOT (
+            (o.mun = '063' AND o.nombre ILIKE ANY(ARRAY['%%JESÚS POBRE%%','%%JESUS POBRE%%','%%LA XARA%%','%%LA JARA%%']))
+            OR
+            (o.mun = '006' AND o.nombre ILIKE ANY(ARRAY['%%LLOSA DE CAMACHO%%','%%LLOSA DE CAMATXO%%']))
+        )
+        AND (
+            -- Municipios en los que no se desea filtrar obras, y se prefiere que aparezcan todas
+            o.mun IN ('001','002','008','016','022','024','026','030','033','045','048','051','062','073','075','085','086','088','101','106','107','110','112','120','130','135','136','137') 
+            -- Filtros de obras que no se desea que aparezcan
+            OR (
+                -- Se descartan las ejecutadas por el Área de Infraestructuras (Cooperacion) ya que ellos nos pasan estados y proyectos finales
+                (o.ejecucion IS NULL OR o.ejecucion NOT IN ('DIIN')) 
+                -- Se descartan actuaciones del PAE ya que el Área de Medio Ambiente nos facilita estados y proyectos
+                AND (o.plan_obra IS NULL OR o.plan_obra NOT ILIKE '%%PAE %%')
+                -- Se descartan actuaciones del Área de Ciclo Hídrico ya que ellos nos facilita estados y proyectos
+                AND (o.subvencion IS NULL OR o.subvencion <> 'DICH')
                 )
-                AND (
-                    -- Municipios en los que no se desea filtrar obras, y se prefiere que aparezcan todas
-                    o.mun IN ('001','002','008','016','022','024','026','030','033','045','048','051','062','073','075','085','086','088','101','106','107','110','112','120','130','135','136','137') 
-                    -- Filtros de obras que no se desea que aparezcan
-                    OR (
-                        -- Se descartan las ejecutadas por el Área de Infraestructuras (Cooperacion) ya que ellos nos pasan estados y proyectos finales
-                        (o.ejecucion IS NULL OR o.ejecucion NOT IN ('DIIN')) 
-                        -- Se descartan actuaciones del PAE ya que el Área de Medio Ambiente nos facilita estados y proyectos
-                        AND (o.plan_obra IS NULL OR o.plan_obra NOT ILIKE '%%PAE %%')
-                        -- Se descartan actuaciones del Área de Ciclo Hídrico ya que ellos nos facilita estados y proyectos
-                        AND (o.subvencion IS NULL OR o.subvencion <> 'DICH')
-                        )
-                    )
-                ORDER BY o.orden;
-        """
-        cur.execute(sql, (mun,))
-        rows = cur.fetchall()
-        
-        obras = []
-        for r in rows:
-            obras.append({
-                "clave": r["clave"], 
-                "mun": r["mun"], 
-                "orden": r["orden"],
-                "nombre": r["nombre"], 
-                "plan_obra": r["plan_obra"], 
-                "estado": r["estado"],
-                "proyecto": r["proyecto"], 
-                "cond": r["cond"],
-                "link_licitacion": (r["link_licitacion"] or "").strip() if r["link_licitacion"] else ""
-            })
-        return obras
+            )
+        ORDER BY o.mun, o.orden;
+"""
+
+def cargar_obras(conn, fase, municipios=None):
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        filas = _consultar(cur, "obras", SQL_OBRAS.format(filtro_mun=_filtro_mun("o.mun", municipios)), _params(fase, municipios))
+        indice = {}
+        with medir("*", "obras", "transform", len(filas)):
+            for r in filas:
+                indice.setdefault(r["mun"], []).append({
+                    "clave": r["clave"], 
+                    "mun": r["mun"], 
+                    "orden": r["orden"],
+                    "nombre": r["nombre"], 
+                    "plan_obra": r["plan_obra"], 
+                    "estado": r["estado"],
+                    "proyecto": r["proyecto"], 
+                    "cond": r["cond"],
+                    "link_licitacion": (r["link_licitacion"] or "").strip() if r["link_licitacion"] else ""
+                })
+        return indice
+
+SQL_AVISOS = """
+    SELECT mun, tipo_formulario, mensaje, prioridad, url
+    FROM coordinador.solicitud_datos_formularios
+    WHERE fase = %(fase)s
+        AND recibido IS NOT TRUE
+        {filtro_mun}
+    ORDER BY mun, tipo_formulario, prioridad DESC, id ASC
+"""
+
+def cargar_avisos(conn, fase, municipios=None):
+    """
+    Recupera los avisos de todos los formularios, indexados por (mun, tipo_formulario).
+    Los errores se propagan: con --incremental, unas páginas sin sus avisos quedarían
+    registradas como al día hasta el siguiente cambio en origen.
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+        filas = _consultar(cursor, "avisos", SQL_AVISOS.format(filtro_mun=_filtro_mun("mun", municipios)), _params(fase, municipios))
+        indice = {}
+        with medir("*", "avisos", "transform", len(filas)):
+            for row in filas:
+                indice.setdefault((row["mun"], row["tipo_formulario"]), []).append(
+                    {"mensaje": row["mensaje"], "prioridad": row["prioridad"], "url": row["url"]})
+        return indice
+
+SQL_CEMENTERIOS = """
+    SELECT mun, nombre FROM cementerio
+    WHERE fase = %(fase)s
+        {filtro_mun}
+        -- Se quitan cementerios de confesiones religiosas menos en Benasau
+        AND (mun = '022' or (titular is null or titular <> 'CR'))
+    ORDER BY mun, nombre;
+"""
+
+def cargar_cementerios(conn, fase, municipios=None):
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        filas = _consultar(cur, "cementerios", SQL_CEMENTERIOS.format(filtro_mun=_filtro_mun("mun", municipios)), _params(fase, municipios))
+        indice = {}
+        with medir("*", "cementerios", "transform", len(filas)):
+            for r in filas:
+                indice.setdefault(r["mun"], []).append({"nombre": r["nombre"] or "Sin nombre"})
+        return indice
+
+# Unión de las 11 tablas de equipamientos (compartida con la huella de cambios).
+# UNION ALL: el cod lleva la clave de cada tabla, así que las ramas no se solapan y
+# sobra la ordenación/hash de UNION para quitar duplicados.
+SQL_EQUIPAMIENTOS_UNION = """
+    with t as (
+        select 'CASA CONSISTORIAL' as tabla, cc.mun, cc.clave || cc.mun || cc.orden_casa as cod, cc.nombre, cc.estado, '316' capa, idu, cc.geom from casa_consistorial cc where cc.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'CENTRO CULTURAL', cu.mun, cu.clave || cu.mun || cu.orden_centro, cu.nombre, cu.estado, '321', idu, cu.geom from cent_cultural cu where cu.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'CENTRO ASISTENCIAL', ca.mun, ca.clave || ca.mun || ca.orden_casis, ca.nombre, ca.estado, '319', idu, ca.geom from centro_asistencial ca where ca.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'CENTRO ENSEÑANZA', en.mun, en.clave || en.mun || en.orden_cent, en.nombre, en.estado, '322', idu, en.geom from centro_ensenanza en where en.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'CENTRO SANITARIO', sa.mun, sa.clave || sa.mun || sa.orden_csan, sa.nombre, sa.estado, '327', idu, sa.geom from centro_sanitario sa where sa.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'EDIFICIO SIN USO', su.mun, su.clave || su.mun || su.orden_edific, su.nombre, su.estado, '328', idu, su.geom from edific_pub_sin_uso su where su.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'INSTALACIÓN DEPORTIVA', id.mun, id.clave || id.mun || id.orden_instal, id.nombre, id.estado, '323', idu, id.geom from instal_deportiva id where id.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'MERCADO/LONJA', lm.mun, lm.clave || lm.mun || lm.orden_lmf, lm.nombre, lm.estado, '324', idu, lm.geom from lonja_merc_feria lm where lm.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'PARQUE', pj.mun, pj.clave || pj.mun || pj.orden_parq, pj.nombre, pj.estado, '331', idu, pj.geom from parque pj where pj.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'PROTECCIÓN CIVIL', ip.mun, ip.clave || ip.mun || ip.orden_prot, ip.nombre, ip.estado, '325', idu, ip.geom from proteccion_civil ip where ip.fase = %(fase)s {filtro_mun}
+        UNION ALL select 'TANATORIO', ta.mun, ta.clave || ta.mun || ta.orden_tanat, ta.nombre, ta.estado, '326', idu, ta.geom from tanatorio ta where ta.fase = %(fase)s {filtro_mun}
+    )
+"""
+
+SQL_EQUIPAMIENTOS = SQL_EQUIPAMIENTOS_UNION + """
+    -- Solo las columnas que usan las plantillas. De la geometría solo sale su md5: el
+    -- centroide para url_visor sale de la caché del visor (completar_visor)
+    select t.tabla, t.mun, t.cod, t.nombre, t.estado, t.capa, t.idu,
+        case when estado='B' then 'Bueno' when estado='R' then 'Regular' when estado='M' then 'Malo' when estado='E' then 'En ejecución' else 'Desconocido' end as estado_txt,
+        concat('https://visoreiel.geonet.es/Manejadores/ObtenerMIME.ashx?entidad=', capa, '&atributo=foto&tipo=image/jpeg;jpg&identificador=', idu) as url_foto,
+        t.capa || ':' || t.idu as clave_visor, md5(st_asbinary(t.geom)) as geom_md5
+    from t
+    order by mun, cod;
+"""
+
+# Centroide (WGS84, como texto: igual que lo ponía concat() en la URL) de las entidades pedidas
+SQL_EQUIPAMIENTOS_CENTROIDES = SQL_EQUIPAMIENTOS_UNION + """
+    select clave_visor, geom_md5, st_x(c)::text as x, st_y(c)::text as y
+    from (
+        select t.capa || ':' || t.idu as clave_visor, md5(st_asbinary(t.geom)) as geom_md5,
+            st_centroid(st_transform(t.geom, 4326)) as c
+        from t
+        where t.capa || ':' || t.idu = any(%(claves)s)
+    ) q;
+"""
+
+# Mapeo de iconos de Lucide para cada categoría
+ICONOS_EQUIPAMIENTOS = {
+    'CASA CONSISTORIAL': 'landmark', 'CENTRO CULTURAL': 'library', 'CENTRO ASISTENCIAL': 'heart-pulse',
+    'CENTRO ENSEÑANZA': 'graduation-cap', 'CENTRO SANITARIO': 'hospital', 'EDIFICIO SIN USO': 'door-closed',
+    'INSTALACIÓN DEPORTIVA': 'volleyball', 'MERCADO/LONJA': 'shopping-cart', 'PARQUE': 'tree-pine',
+    'PROTECCIÓN CIVIL': 'shield-alert', 'TANATORIO': 'flower-2'
+}
+
+def equipamientos_vacios():
+    return {"general": {}, "sin_uso": []}
+
+def _agrupar_equipamiento(equip, r):
+    r_dict = dict(r)
+    r_dict['icono'] = ICONOS_EQUIPAMIENTOS.get(r['tabla'], 'building')
+    
+    if r['tabla'] == 'EDIFICIO SIN USO':
+        equip["sin_uso"].append(r_dict)
+    else:
+        equip["general"].setdefault(r['tabla'], []).append(r_dict)
+
+def cargar_equipamientos(conn, fase, municipios=None):
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        # Cada rama del UNION lleva su propio filtro (sobre su única tabla)
+        filas = _consultar(cur, "equipamientos", SQL_EQUIPAMIENTOS.format(filtro_mun=_filtro_mun("mun", municipios)), _params(fase, municipios))
+        filas = [dict(r) for r in filas]
+        completar_visor(cur, fase, filas, municipios)
+        indice = {}
+        with medir("*", "equipamientos", "transform", len(filas)):
+            for r in filas:
+                _agrupar_equipamiento(indice.setdefault(r['mun'], equipamientos_vacios()), r)
+        return indice
+
+def iterar_equipamientos(conn, fase, municipios=None, itersize=200):
+    """
+    Como cargar_equipamientos, pero leyendo de un cursor con nombre (en el servidor)
+    de `itersize` en `itersize` filas y entregando (mun, equipamientos) municipio a
+    municipio: en memoria solo está el municipio en curso.
+    """
+    with conn.cursor(name="eiel_equipamientos", cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.itersize = itersize
+        with medir("*", "equipamientos", "query"):
+            cur.execute(SQL_EQUIPAMIENTOS.format(filtro_mun=_filtro_mun("mun", municipios)), _params(fase, municipios))
+        # Los centroides que falten se piden por otro cursor de la misma conexión
+        with conn.cursor() as cur_visor:
+            for mun, filas in itertools.groupby(cur, key=lambda r: r['mun']):
+                filas = [dict(r) for r in filas]
+                completar_visor(cur_visor, fase, filas, [mun])
+                equip = equipamientos_vacios()
+                for r in filas:
+                    _agrupar_equipamiento(equip, r)
+                yield mun, equip
+
+# Conjuntos de datos que precarga cargar_datos (nombre -> cargador masivo)
+CARGADORES = {
+    "depositos": cargar_depositos,
+    "obras": cargar_obras,
+    "equipamientos": cargar_equipamientos,
+    "cementerios": cargar_cementerios,
+    "avisos": cargar_avisos,
+}
+
+def cargar_datos(conn, municipios=None, fase=None, por_conjunto=None, informar=True):
+    """
+    Resuelve la fase una sola vez y precarga cada conjunto de datos para todos los
+    municipios con una consulta por conjunto. El render solo lee de estos índices.
+    Con por_conjunto ({conjunto: municipios}) solo se consulta lo indicado.
+    """
+    if fase is None:
+        fase = obtener_fase_actual(conn)
+    datos = {"fase": fase}
+    for conjunto, cargador in CARGADORES.items():
+        muns = por_conjunto.get(conjunto) if por_conjunto is not None else municipios
+        if por_conjunto is not None and not muns:
+            datos[conjunto] = {}
+        else:
+            datos[conjunto] = cargador(conn, fase, sorted(muns) if muns is not None else None)
+    if not informar:
+        return datos
+    print(f" Datos precargados: {sum(len(v) for v in datos['depositos'].values())} depósitos, "
+          f"{sum(len(v) for v in datos['obras'].values())} obras, "
+          f"{len(datos['equipamientos'])} municipios con equipamientos, "
+          f"{sum(len(v) for v in datos['cementerios'].values())} cementerios, "
+          f"{sum(len(v) for v in datos['avisos'].values())} avisos.")
+    return datos
+
+def avisos_de(datos, mun, tipo_form):
+    return datos["avisos"].get((mun, tipo_form), [])
+
+# --- CONSULTAS POR MUNICIPIO (uso puntual; la generación usa cargar_datos) ---
+def obtener_depositos(conn, mun):
+    return cargar_depositos(conn, obtener_fase_actual(conn), [mun]).get(mun, [])
+
+def obtener_obras(conn, mun):
+    return cargar_obras(conn, obtener_fase_actual(conn), [mun]).get(mun, [])
 
 # --- OBTENCION DE REQUERIMIENTOS ESPECÍFICOS ---
 def obtener_avisos_personalizados(conn, codigo_ine, fase, tipo_form):
     """
-    Recupera los avisos específicos para un municipio y formulario.
-    """
-    sql = """
-        SELECT mensaje, prioridad, url
-        FROM coordinador.solicitud_datos_formularios
-        WHERE mun = %s 
-            AND fase = %s 
-            AND tipo_formulario = %s
-            AND recibido IS NOT TRUE
-        ORDER BY prioridad DESC, id ASC
+    Recupera los avisos específicos para un municipio y formulario (sin avisos si falla la consulta).
     """
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            cursor.execute(sql, (codigo_ine, fase, tipo_form))
-            # Al ser DictCursor, cada aviso ya llevará la clave 'url'
-            return [dict(row) for row in cursor.fetchall()]
+        return cargar_avisos(conn, fase, [codigo_ine]).get((codigo_ine, tipo_form), [])
     except Exception as e:
         print(f"Error obteniendo avisos para {codigo_ine} ({tipo_form}): {e}")
+        conn.rollback()
         return []
         
 # --- OBTENCION DE CEMENTERIOS ---
 def obtener_cementerios(conn, mun):
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        # Se quitan cementerios de confesiones religiosas menos en Benasau
-        cur.execute(
-            "SELECT nombre FROM cementerio WHERE fase = (SELECT max(fase) FROM geonet_fase) AND mun = %s AND (mun = '022' or (titular is null or titular <> 'CR')) ORDER BY nombre;", (mun,))
-        return [{"nombre": r["nombre"] or "Sin nombre"} for r in cur.fetchall()]
+    return cargar_cementerios(conn, obtener_fase_actual(conn), [mun]).get(mun, [])
+
+# --- OBTENCION DE EQUIPAMIENTOS ---
+def obtener_equipamientos(conn, mun):
+    return cargar_equipamientos(conn, obtener_fase_actual(conn), [mun]).get(mun, equipamientos_vacios())
 
-def copiar_assets():
+def copiar_assets(rels=None):
     # docs/ es el artefacto de GitHub Pages: css/assets/js se copian desde el repo.
     # Editar js/eiel-forms.js (fuente); docs/js/ se regenera aquí.
-    if os.path.exists(ASSETS_CSS_DIR):
-        shutil.copytree(ASSETS_CSS_DIR, os.path.join(OUTPUT_DIR, 'css'), dirs_exist_ok=True)
-    if os.path.exists(ASSETS_DIR):
-        shutil.copytree(ASSETS_DIR, os.path.join(OUTPUT_DIR, 'assets'), dirs_exist_ok=True)
-    if os.path.exists(ASSETS_JS_DIR):
-        shutil.copytree(ASSETS_JS_DIR, os.path.join(OUTPUT_DIR, 'js'), dirs_exist_ok=True)
+    # Cada fichero va con su nombre de siempre (enlaces externos, appscript) y con la
+    # huella en el nombre (lo que enlazan las páginas). Solo se copia lo que ha cambiado
+    # (con `rels`, solo se miran esos; --watch). Las huellas antiguas no se tocan aquí:
+    # ver retirar_huellas_antiguas.
+    copiados = 0
+    for rel, entrada in mapa_assets().items():
+        if rels is not None and rel not in rels:
+            continue
+        for destino in (rel, entrada["huella"]):
+            ruta = os.path.join(OUTPUT_DIR, *destino.split("/"))
+            if os.path.exists(ruta) and filecmp.cmp(entrada["origen"], ruta, shallow=False):
+                continue
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            shutil.copy2(entrada["origen"], ruta)
+            copiados += 1
+    if copiados:
+        print(f" Assets: {copiados} copiados.")
 
-# --- OBTENCION DE EQUIPAMIENTOS ---
-def obtener_equipamientos(conn, mun):
-    sql = """
-    with t as (
-        select 'CASA CONSISTORIAL' as tabla, cc.clave || cc.mun || cc.orden_casa as cod, cc.nombre, cc.estado, '316' capa, idu, cc.geom from casa_consistorial cc where cc.fase = (select max(fase) from geonet_fase) and cc.mun = %s
-        UNION select 'CENTRO CULTURAL', cu.clave || cu.mun || cu.orden_centro, cu.nombre, cu.estado, '321', idu, cu.geom from cent_cultural cu where cu.fase = (select max(fase) from geonet_fase) and cu.mun = %s
-        UNION select 'CENTRO ASISTENCIAL', ca.clave || ca.mun || ca.orden_casis, ca.nombre, ca.estado, '319', idu, ca.geom from centro_asistencial ca where ca.fase = (select max(fase) from geonet_fase) and ca.mun = %s
-        UNION select 'CENTRO ENSEÑANZA', en.clave || en.mun || en.orden_cent, en.nombre, en.estado, '322', idu, en.geom from centro_ensenanza en where en.fase = (select max(fase) from geonet_fase) and en.mun = %s
-        UNION select 'CENTRO SANITARIO', sa.clave || sa.mun || sa.orden_csan, sa.nombre, sa.estado, '327', idu, sa.geom from centro_sanitario sa where sa.fase = (select max(fase) from geonet_fase) and sa.mun = %s
-        UNION select 'EDIFICIO SIN USO', su.clave || su.mun || su.orden_edific, su.nombre, su.estado, '328', idu, su.geom from edific_pub_sin_uso su where su.fase = (select max(fase) from geonet_fase) and su.mun = %s
-        UNION select 'INSTALACIÓN DEPORTIVA', id.clave || id.mun || id.orden_instal, id.nombre, id.estado, '323', idu, id.geom from instal_deportiva id where id.fase = (select max(fase) from geonet_fase) and id.mun = %s
-        UNION select 'MERCADO/LONJA', lm.clave || lm.mun || lm.orden_lmf, lm.nombre, lm.estado, '324', idu, lm.geom from lonja_merc_feria lm where lm.fase = (select max(fase) from geonet_fase) and lm.mun = %s
-        UNION select 'PARQUE', pj.clave || pj.mun || pj.orden_parq, pj.nombre, pj.estado, '331', idu, pj.geom from parque pj where pj.fase = (select max(fase) from geonet_fase) and pj.mun = %s
-        UNION select 'PROTECCIÓN CIVIL', ip.clave || ip.mun || ip.orden_prot, ip.nombre, ip.estado, '325', idu, ip.geom from proteccion_civil ip where ip.fase = (select max(fase) from geonet_fase) and ip.mun = %s
-        UNION select 'TANATORIO', ta.clave || ta.mun || ta.orden_tanat, ta.nombre, ta.estado, '326', idu, ta.geom from tanatorio ta where ta.fase = (select max(fase) from geonet_fase) and ta.mun = %s
-    )
-    select t.*, 
-        case when estado='B' then 'Bueno' when estado='R' then 'Regular' when estado='M' then 'Malo' when estado='E' then 'En ejecución' else 'Desconocido' end as estado_txt,
-        concat('https://visoreiel.geonet.es/Manejadores/ObtenerMIME.ashx?entidad=', capa, '&atributo=foto&tipo=image/jpeg;jpg&identificador=', idu) as url_foto,
-        concat('https://visoreiel.geonet.es?srs=4326&x_lon=', st_x(st_centroid(st_transform(geom, 4326))), '&y_lat=', st_y(st_centroid(st_transform(geom, 4326))), '&zoom=19&w=initlayer&layerIds=', capa) as url_visor
-    from t
-    order by cod;
+def retirar_huellas_antiguas():
+    # Huellas de versiones anteriores (y sus .gz/.br). Solo tras regenerar todas las
+    # páginas: las que no se regeneran siguen enlazando la huella con la que se hicieron.
+    vigentes = {os.path.join(OUTPUT_DIR, *entrada["huella"].split("/")) for entrada in mapa_assets().values()}
+    retirados = 0
+    for carpeta in DIRS_ASSETS:
+        for raiz, _, ficheros in os.walk(os.path.join(OUTPUT_DIR, carpeta)):
+            for nombre in ficheros:
+                ruta = os.path.join(raiz, nombre)
+                base = ruta[:-len(os.path.splitext(ruta)[1])] if nombre.endswith(EXT_LATERALES) else ruta
+                if PATRON_ASSET_HUELLA.match(os.path.basename(base)) and base not in vigentes:
+                    os.remove(ruta)
+                    retirados += 1
+    if retirados:
+        print(f" Assets: {retirados} huellas antiguas retiradas.")
+
+# --- PRECOMPRESIÓN (.gz / .br junto a cada fichero) ---
+# Para servidores que entregan el fichero comprimido tal cual (gzip_static, brotli_static...).
+try:
+    import brotli
+except ImportError:  # opcional: sin él solo se generan los .gz
+    brotli = None
+
+EXT_PRECOMPRIMIR = (".html", ".css", ".js", ".json")
+EXT_LATERALES = (".gz", ".br")
+
+def _gzip(datos):
+    # mtime=0: mismo contenido, mismo .gz (no ensucia el diff de docs/)
+    return gzip.compress(datos, compresslevel=9, mtime=0)
+
+def precomprimir(ruta):
+    """Escribe ruta.gz / ruta.br si están desfasados y ocupan menos que el original."""
+    st = os.stat(ruta)
+    crudo = None
+    escritos = 0
+    for ext, comprimir in ((".gz", _gzip), (".br", brotli.compress if brotli else None)):
+        lateral = ruta + ext
+        if comprimir is None:
+            continue
+        try:
+            if os.stat(lateral).st_mtime_ns >= st.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        if crudo is None:
+            with open(ruta, "rb") as f:
+                crudo = f.read()
+        datos = comprimir(crudo)
+        if len(datos) < len(crudo):
+            with open(lateral, "wb") as f:
+                f.write(datos)
+            escritos += 1
+        elif os.path.exists(lateral):
+            os.remove(lateral)
+    return escritos
+
+def precomprimir_salida(nombres):
+    """Precomprime las salidas indicadas y los assets publicados."""
+    rutas = [os.path.join(OUTPUT_DIR, *n.split("/")) for n in nombres]
+    for rel, entrada in mapa_assets().items():
+        rutas += [os.path.join(OUTPUT_DIR, *d.split("/")) for d in (rel, entrada["huella"])]
+    escritos = sum(precomprimir(r) for r in rutas if r.endswith(EXT_PRECOMPRIMIR) and os.path.exists(r))
+    print(f" Precompresión: {escritos} ficheros .gz{'/.br' if brotli else ''} actualizados"
+          + ("" if brotli else " (sin módulo brotli: solo .gz)") + ".")
+
+def retirar_precomprimidos():
+    # Generación completa sin --precomprimir: los laterales se quedarían desfasados
+    retirados = 0
+    for raiz, _, ficheros in os.walk(OUTPUT_DIR):
+        for nombre in ficheros:
+            if nombre.endswith(EXT_LATERALES) and os.path.splitext(nombre)[0].endswith(EXT_PRECOMPRIMIR):
+                os.remove(os.path.join(raiz, nombre))
+                retirados += 1
+    if retirados:
+        print(f" Retirados {retirados} ficheros precomprimidos (generación sin --precomprimir).")
+
+# --- PÁGINAS COMPACTAS (--compactar) ---
+# Los <script data-compartido="x"> de las plantillas no llevan nada del municipio: salen a
+# docs/compartido/x.<hash>.js, que se descarga una vez y sirve para todas las páginas.
+# En la página queda solo lo que cambia (EIEL_CONFIG, EIEL_DATOS) y el HTML se minifica.
+COMPARTIDOS_DIR = "compartido"
+PATRON_SCRIPT_COMPARTIDO = re.compile(r'<script data-compartido="([\w-]+)">(.*?)</script>', re.S)
+PATRON_HTML_PROTEGIDO = re.compile(r"<(script|style|pre|textarea)\b.*?</\1\s*>", re.S | re.I)
+# Una etiqueta (con atributos entrecomillados, que pueden llevar ">") o un tramo de espacios
+PATRON_HTML_ESPACIOS = re.compile(r"""(<(?:[^>"']|"[^"]*"|'[^']*')*>)|[ \t\r\n\f]+""")
+
+def _colapsar_espacios(m):
+    if m.group(1):
+        return m.group(1)
+    return "\n" if "\n" in m.group(0) else " "
+
+def minificar_html(html):
+    """Colapsa los espacios entre etiquetas y del texto; script, style, pre y textarea quedan intactos."""
+    partes = []
+    pos = 0
+    for m in PATRON_HTML_PROTEGIDO.finditer(html):
+        partes.append(PATRON_HTML_ESPACIOS.sub(_colapsar_espacios, html[pos:m.start()]))
+        partes.append(m.group(0))
+        pos = m.end()
+    partes.append(PATRON_HTML_ESPACIOS.sub(_colapsar_espacios, html[pos:]))
+    return "".join(partes)
+
+def compactar_pagina(salida, html):
+    """Saca los scripts compartidos a su fichero (uno por contenido) y minifica la página."""
+    compactacion = salida["compactacion"]
+
+    def externalizar(m):
+        cuerpo = m.group(2)
+        fichero = f"{COMPARTIDOS_DIR}/{m.group(1)}.{_hash_texto(cuerpo)[:10]}.js"
+        if fichero not in compactacion["compartidos"]:
+            compactacion["compartidos"].add(fichero)
+            compactacion["js"] += len(cuerpo.encode("utf-8"))
+            escribir_salida(salida, fichero, cuerpo)
+        return f'<script src="{fichero}"></script>'
+
+    compacto = minificar_html(PATRON_SCRIPT_COMPARTIDO.sub(externalizar, html))
+    compactacion["paginas"] += 1
+    compactacion["antes"] += len(html.encode("utf-8"))
+    compactacion["despues"] += len(compacto.encode("utf-8"))
+    return compacto
+
+def informe_compactacion(compactacion):
+    n = compactacion["paginas"]
+    if not n:
+        return
+    antes, despues, js = compactacion["antes"], compactacion["despues"], compactacion["js"]
+    print(f" Compactación: {n} páginas, {antes / 1e6:.2f} MB → {despues / 1e6:.2f} MB "
+          f"+ {js / 1e3:.1f} KB en {len(compactacion['compartidos'])} JS compartidos "
+          f"({100 * (1 - (despues + js) / antes):.0f}% menos).")
+    print(f"   Por visita (JS compartidos en caché): {antes / n / 1e3:.1f} KB → {despues / n / 1e3:.1f} KB por página.")
+
+# --- ESCRITURA INCREMENTAL (MANIFIESTO DE SALIDA) ---
+# Se guarda fuera de docs/ para no publicarlo en Pages.
+BUILD_DIR = os.path.join(BASE_DIR, ".build")
+MANIFEST_FILE = os.path.join(BUILD_DIR, "manifest.json")
+CAMBIOS_FILE = os.path.join(BUILD_DIR, "cambios.json")
+
+# Páginas que produce el generador; lo que case y no se haya generado se poda
+PATRON_PAGINAS = re.compile(r"^(agua|obras|residuos|equipamientos|cementerios|alumbrado|viario|saneamiento)_\d+\.html$")
+
+def _hash_texto(contenido):
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+def _hash_en_disco(ruta, entrada):
+    # Si tamaño y fecha coinciden con el manifiesto nos fiamos del hash guardado;
+    # si no (checkout, edición a mano...), se vuelve a calcular desde el fichero.
+    try:
+        st = os.stat(ruta)
+    except FileNotFoundError:
+        return None
+    if entrada and entrada.get("bytes") == st.st_size and entrada.get("mtime_ns") == st.st_mtime_ns:
+        return entrada.get("sha256")
+    h = hashlib.sha256()
+    with open(ruta, "r", encoding="utf-8") as f:
+        for trozo in iter(lambda: f.read(1 << 16), ""):
+            h.update(trozo.encode("utf-8"))
+    return h.hexdigest()
+
+def abrir_salida(compactar=False):
+    anterior = {}
+    if os.path.exists(MANIFEST_FILE):
+        try:
+            with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+                anterior = json.load(f).get("ficheros", {})
+        except (ValueError, OSError) as e:
+            print(f"⚠️ AVISO: manifiesto ilegible ({e}); se compara contra los ficheros en disco.")
+    compactacion = {"paginas": 0, "antes": 0, "despues": 0, "js": 0, "compartidos": set()} if compactar else None
+    return {"anterior": anterior, "actual": {}, "nuevos": [], "cambiados": [], "sin_cambios": 0,
+            "compactacion": compactacion}
+
+def _registrar_salida(salida, nombre, ruta, sha, previo, etapa, t0):
+    if previo is None:
+        salida["nuevos"].append(nombre)
+    elif previo != sha:
+        salida["cambiados"].append(nombre)
+    else:
+        salida["sin_cambios"] += 1
+    st = os.stat(ruta)
+    salida["actual"][nombre] = {"sha256": sha, "bytes": st.st_size, "mtime_ns": st.st_mtime_ns}
+    mun, form = _clave_pagina(nombre)
+    registrar_medida(mun, form, etapa, time.perf_counter() - t0, bytes=st.st_size)
+
+def escribir_salida(salida, nombre, contenido):
+    """
+    Escribe docs/<nombre> solo si su contenido ha cambiado. Devuelve True si se ha escrito.
     """
+    t0 = time.perf_counter()
+    if salida["compactacion"] is not None and nombre.endswith(".html"):
+        contenido = compactar_pagina(salida, contenido)
+    ruta = os.path.join(OUTPUT_DIR, nombre)
+    if "/" in nombre:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    sha = _hash_texto(contenido)
+    previo = _hash_en_disco(ruta, salida["anterior"].get(nombre))
+
+    escrito = previo != sha
+    if escrito:
+        with open(ruta, "w", encoding="utf-8") as f:
+            f.write(contenido)
+    _registrar_salida(salida, nombre, ruta, sha, previo, "write", t0)
+    return escrito
+
+def escribir_salida_stream(salida, nombre, trozos):
+    """
+    Como escribir_salida, pero volcando los trozos (p. ej. template.stream()) a un
+    temporal mientras se calcula el hash, sin montar la página entera en memoria.
+    """
+    if salida["compactacion"] is not None and nombre.endswith(".html"):
+        # Los scripts compartidos y la minificación necesitan la página entera
+        return escribir_salida(salida, nombre, "".join(trozos))
+    t0 = time.perf_counter()
+    ruta = os.path.join(OUTPUT_DIR, nombre)
+    if "/" in nombre:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = ruta + ".tmp"
+    h = hashlib.sha256()
+    with open(temporal, "w", encoding="utf-8") as f:
+        for trozo in trozos:
+            h.update(trozo.encode("utf-8"))
+            f.write(trozo)
+    sha = h.hexdigest()
+    previo = _hash_en_disco(ruta, salida["anterior"].get(nombre))
+
+    escrito = previo != sha
+    if escrito:
+        os.replace(temporal, ruta)
+    else:
+        os.remove(temporal)
+    # En stream el render y la escritura van juntos: se anotan como "render"
+    _registrar_salida(salida, nombre, ruta, sha, previo, "render", t0)
+    return escrito
+
+def cerrar_salida(salida, ambito=None, listar=True):
+    """
+    Poda las salidas que ya no se generan, guarda el manifiesto y la lista de cambios.
+    Con `ambito` (generación parcial) solo se poda dentro de esas rutas; el resto de
+    entradas del manifiesto anterior se conservan. Con listar=False solo se da el resumen.
+    """
+    if ambito is None:
+        sobrantes = set(salida["anterior"]) - set(salida["actual"])
+        sobrantes.update(n for n in os.listdir(OUTPUT_DIR) if PATRON_PAGINAS.match(n) and n not in salida["actual"])
+    else:
+        sobrantes = set(ambito) - set(salida["actual"])
+        for nombre, entrada in salida["anterior"].items():
+            if nombre not in ambito:
+                salida["actual"].setdefault(nombre, entrada)
+    eliminados = []
+    for nombre in sorted(sobrantes):
+        ruta = os.path.join(OUTPUT_DIR, nombre)
+        for lateral in EXT_LATERALES:
+            if os.path.exists(ruta + lateral):
+                os.remove(ruta + lateral)
+        if os.path.exists(ruta):
+            os.remove(ruta)
+            eliminados.append(nombre)
+        # Carpetas que se quedan vacías (data/equipamientos_014/ y luego data/)
+        raiz = os.path.normpath(OUTPUT_DIR)
+        carpeta = os.path.dirname(os.path.normpath(ruta))
+        while carpeta != raiz and carpeta.startswith(raiz + os.sep) and os.path.isdir(carpeta) and not os.listdir(carpeta):
+            os.rmdir(carpeta)
+            carpeta = os.path.dirname(carpeta)
+
+    cambios = {"nuevos": sorted(salida["nuevos"]), "cambiados": sorted(salida["cambiados"]), "eliminados": eliminados}
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    with open(MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump({"ficheros": dict(sorted(salida["actual"].items()))}, f, ensure_ascii=False, indent=1)
+    with open(CAMBIOS_FILE, "w", encoding="utf-8") as f:
+        json.dump(cambios, f, ensure_ascii=False, indent=1)
+
+    print(f"\n Salida: {len(cambios['nuevos'])} nuevos, {len(cambios['cambiados'])} cambiados, "
+          f"{len(eliminados)} eliminados, {salida['sin_cambios']} sin cambios.")
+    if salida["compactacion"] is not None:
+        informe_compactacion(salida["compactacion"])
+    for etiqueta, clave in (("+", "nuevos"), ("~", "cambiados"), ("-", "eliminados")):
+        for nombre in cambios[clave] if listar else ():
+            print(f"   {etiqueta} {nombre}")
+    return cambios
+
+# --- REGISTRO DE FORMULARIOS ---
+# Cada formulario declara su plantilla, los conjuntos de datos de los que depende
+# (lo que se carga y lo que entra en su huella; "avisos:<tipo>" son sus avisos), el
+# contexto propio que añade al común y, si es bajo demanda, cuándo se publica.
+# contexto(datos, code, escribir, equip_lazy) -> dict; condicion(datos, code, avisos) -> bool
+def _contexto_agua(datos, code, escribir, equip_lazy):
+    return {"depositos_json": json.dumps(datos["depositos"].get(code, []), ensure_ascii=False)}
+
+def _contexto_obras(datos, code, escribir, equip_lazy):
+    return {"obras": datos["obras"].get(code, [])}
+
+def _contexto_equipamientos(datos, code, escribir, equip_lazy):
+    equip_data = datos["equipamientos"].get(code, equipamientos_vacios())
+    lazy = None
+    if equip_en_diferido(equip_data, equip_lazy):
+        ficheros = ficheros_equip_lazy(code, equip_data)
+        for nombre, contenido in ficheros.values():
+            escribir(nombre, plantilla_datos(), {"contenido": contenido})
+        lazy = {"ficheros": {cat: nombre for cat, (nombre, _) in ficheros.items()}, "pagina": equip_lazy["pagina"]}
+    return {"equipamientos_agrupados": equip_data, "equip_lazy": lazy}
+
+def _contexto_cementerios(datos, code, escribir, equip_lazy):
+    cementerios = datos["cementerios"].get(code, [])
+    return {"cementerios": cementerios, "cementerios_json": json.dumps(cementerios, ensure_ascii=False)}
+
+def _sin_contexto(datos, code, escribir, equip_lazy):
+    return {}
+
+def _hay_avisos(datos, code, avisos):
+    return len(avisos) > 0
+
+REGISTRO_FORMULARIOS = {
+    # A) Formularios estándar (siempre se generan)
+    'agua': {"plantilla": TEMPLATE_AGUA, "dependencias": ['depositos', 'avisos:agua'],
+             "contexto": _contexto_agua, "condicion": None},
+    'obras': {"plantilla": TEMPLATE_OBRAS, "dependencias": ['obras', 'avisos:obras'],
+              "contexto": _contexto_obras, "condicion": None},
+    'residuos': {"plantilla": TEMPLATE_RESIDUOS, "dependencias": ['avisos:residuos'],
+                 "contexto": _sin_contexto, "condicion": None},
+    'equipamientos': {"plantilla": TEMPLATE_EQUIPAMIENTOS, "dependencias": ['equipamientos', 'avisos:equipamientos'],
+                      "contexto": _contexto_equipamientos, "condicion": None},
+    # B) Formularios bajo demanda: cementerios si el municipio tiene; el resto si hay avisos
+    'cementerios': {"plantilla": TEMPLATE_CEMENTERIOS, "dependencias": ['cementerios', 'avisos:cementerios'],
+                    "contexto": _contexto_cementerios,
+                    "condicion": lambda datos, code, avisos: len(datos["cementerios"].get(code, [])) > 0},
+    'alumbrado': {"plantilla": TEMPLATE_ALUMBRADO, "dependencias": ['avisos:alumbrado'],
+                  "contexto": _sin_contexto, "condicion": _hay_avisos},
+    'viario': {"plantilla": TEMPLATE_VIARIO, "dependencias": ['avisos:viario'],
+               "contexto": _sin_contexto, "condicion": _hay_avisos},
+    'saneamiento': {"plantilla": TEMPLATE_SANEAMIENTO, "dependencias": ['avisos:saneamiento'],
+                    "contexto": _sin_contexto, "condicion": _hay_avisos},
+}
+
+FORMULARIOS = list(REGISTRO_FORMULARIOS)
+FORMULARIOS_FIJOS = [f for f, r in REGISTRO_FORMULARIOS.items() if r["condicion"] is None]
+FORMULARIOS_BAJO_DEMANDA = [f for f, r in REGISTRO_FORMULARIOS.items() if r["condicion"] is not None]
+# Huellas (mun, conjunto) de las que depende cada formulario
+DEPENDENCIAS = {f: r["dependencias"] for f, r in REGISTRO_FORMULARIOS.items()}
+
+def conjuntos_pendientes(pendientes):
+    """{conjunto: municipios} que hay que cargar para renderizar `pendientes` ({code: [form]})."""
+    por_conjunto = {}
+    for c, forms in pendientes.items():
+        for form in forms:
+            for d in DEPENDENCIAS[form]:
+                por_conjunto.setdefault(d.split(":")[0], set()).add(c)
+    return por_conjunto
+
+# --- CACHÉ DE COORDENADAS DEL VISOR (equipamientos) ---
+# Reproyectar cada geometría y calcular su centroide es lo más caro de la consulta de
+# equipamientos. El resultado se guarda en .build/ por (capa, idu) junto al md5 de la
+# geometría: solo se vuelven a calcular las entidades nuevas o que se han movido.
+VISOR_CACHE_FILE = os.path.join(BUILD_DIR, "visor-equipamientos.json")
+URL_VISOR = "https://visoreiel.geonet.es?srs=4326&x_lon={x}&y_lat={y}&zoom=19&w=initlayer&layerIds={capa}"
+# "vistas": claves leídas desde iniciar_poda_visor(); None si la ejecución no las lee todas
+_visor = {"lock": threading.Lock(), "cambiada": False, "vistas": None}
+
+def cache_visor():
+    """{"<capa>:<idu>": [geom_md5, x, y]} (se lee de disco la primera vez)."""
+    if "entradas" not in _visor:
+        entradas = {}
+        if os.path.exists(VISOR_CACHE_FILE):
+            try:
+                with open(VISOR_CACHE_FILE, "r", encoding="utf-8") as f:
+                    entradas = json.load(f)
+            except (ValueError, OSError) as e:
+                print(f"⚠️ AVISO: caché del visor ilegible ({e}); se recalculan los centroides.")
+        _visor["entradas"] = entradas
+    return _visor["entradas"]
+
+def vaciar_cache_visor():
+    _visor["entradas"] = {}
+    _visor["cambiada"] = True
+
+def iniciar_poda_visor():
+    """
+    Para una generación completa desde la BD: se anotan las claves que se lean (en
+    cualquier modo: masivo, --pipeline o --bajo-consumo) y guardar_cache_visor() quita
+    las demás, que son entidades que ya no existen.
+    """
+    with _visor["lock"]:
+        _visor["vistas"] = set()
+
+def completar_visor(cur, fase, filas, municipios=None):
+    """
+    Quita clave_visor y geom_md5 de cada fila de equipamientos y pone url_visor con el
+    centroide de la caché. Los que faltan o cuya geometría ha cambiado se calculan en una
+    sola consulta. Devuelve cuántos centroides se han calculado.
+    """
+    with _visor["lock"]:
+        entradas = cache_visor()
+        if _visor["vistas"] is not None:
+            _visor["vistas"].update(r["clave_visor"] for r in filas)
+        faltan = sorted({r["clave_visor"] for r in filas
+                         if r["clave_visor"] not in entradas or entradas[r["clave_visor"]][0] != r["geom_md5"]})
+        if faltan:
+            sql = SQL_EQUIPAMIENTOS_CENTROIDES.format(filtro_mun=_filtro_mun("mun", municipios))
+            params = {**_params(fase, municipios), "claves": faltan}
+            for clave, geom_md5, x, y in _consultar(cur, "equipamientos:visor", sql, params):
+                # Sin geometría concat() dejaba las coordenadas vacías
+                entradas[clave] = [geom_md5, x or "", y or ""]
+            _visor["cambiada"] = True
+        for r in filas:
+            _, x, y = entradas.get(r.pop("clave_visor"), (None, "", ""))
+            del r["geom_md5"]
+            r["url_visor"] = URL_VISOR.format(x=x, y=y, capa=r["capa"])
+    return len(faltan)
+
+def guardar_cache_visor():
+    with _visor["lock"]:
+        vistas, _visor["vistas"] = _visor["vistas"], None
+        if vistas is not None and "entradas" in _visor:
+            for clave in [c for c in _visor["entradas"] if c not in vistas]:
+                del _visor["entradas"][clave]
+                _visor["cambiada"] = True
+        if not _visor["cambiada"]:
+            return
+        os.makedirs(BUILD_DIR, exist_ok=True)
+        temporal = VISOR_CACHE_FILE + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(_visor["entradas"], f, separators=(",", ":"))
+        os.replace(temporal, VISOR_CACHE_FILE)
+        _visor["cambiada"] = False
+
+# --- DETECCIÓN DE CAMBIOS EN ORIGEN (--incremental) ---
+ESTADO_ORIGEN_FILE = os.path.join(BUILD_DIR, "estado-origen.json")
+
+# Para la huella de equipamientos basta un hash de la geometría (sin reproyectar)
+SQL_EQUIPAMIENTOS_HUELLA = SQL_EQUIPAMIENTOS_UNION + """
+    select tabla, mun, cod, nombre, estado, capa, idu, md5(st_asbinary(geom)) as geom_md5 from t
+"""
+
+# Nº de filas + hash agregado de las filas que verá el render, por municipio
+SQL_HUELLA = """
+    SELECT {claves}, count(*) AS n, md5(string_agg(md5(q::text), '' ORDER BY md5(q::text))) AS h
+    FROM ({consulta}) q
+    GROUP BY {claves}
+"""
+
+HUELLAS = {
+    "depositos": (SQL_DEPOSITOS, "mun"),
+    "obras": (SQL_OBRAS, "mun"),
+    "equipamientos": (SQL_EQUIPAMIENTOS_HUELLA, "mun"),
+    "cementerios": (SQL_CEMENTERIOS, "mun"),
+    "avisos": (SQL_AVISOS, "mun, tipo_formulario"),
+}
+
+def calcular_huellas(conn, fase):
+    """
+    Devuelve {"<mun>|<conjunto>": "<filas>:<md5>"}; los avisos van como "avisos:<tipo>".
+    """
+    huellas = {}
+    with conn.cursor() as cur:
+        for conjunto, (sql, claves) in HUELLAS.items():
+            consulta = sql.format(filtro_mun="").strip().rstrip(";")
+            for row in _consultar(cur, f"huella:{conjunto}", SQL_HUELLA.format(claves=claves, consulta=consulta), _params(fase, None)):
+                if conjunto == "avisos":
+                    mun, tipo, n, h = row
+                    huellas[f"{mun}|avisos:{tipo}"] = f"{n}:{h}"
+                else:
+                    mun, n, h = row
+                    huellas[f"{mun}|{conjunto}"] = f"{n}:{h}"
+    return huellas
+
+def huella_entorno(opciones=None):
+    # Plantillas, generador, assets, URLs, listado y opciones de salida: si cambia algo de esto se regenera todo
+    h = hashlib.sha256()
+    for nombre in sorted(os.listdir(TEMPLATE_DIR)):
+        with open(os.path.join(TEMPLATE_DIR, nombre), "rb") as f:
+            h.update(nombre.encode("utf-8") + f.read())
+    with open(os.path.abspath(__file__), "rb") as f:
+        h.update(f.read())
+    # Las huellas de los assets van en los enlaces de todas las páginas
+    config = configuracion()
+    h.update(json.dumps([config["url_adjuntos"], config["url_adjuntos_worker"], config["url_generar_pdf"],
+                         config["url_logger"], config["url_login_script"], municipios_ui(), opciones, sorted(e["huella"] for e in mapa_assets().values())],
+                        ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+def cargar_estado_origen():
+    if not os.path.exists(ESTADO_ORIGEN_FILE):
+        return None
+    try:
+        with open(ESTADO_ORIGEN_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (ValueError, OSError) as e:
+        print(f"⚠️ AVISO: estado de origen ilegible ({e}); se regenera todo.")
+        return None
+
+def guardar_estado_origen(plan, flags):
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    with open(ESTADO_ORIGEN_FILE, "w", encoding="utf-8") as f:
+        json.dump({"fase": plan["fase"], "entorno": plan["entorno"], "huellas": plan["huellas"], "flags": flags},
+                  f, ensure_ascii=False, indent=1, sort_keys=True)
+
+def planificar_incremental(conn, municipios, opciones=None):
+    """
+    Compara las huellas actuales con las de la última ejecución y decide qué pares
+    (municipio, formulario) hay que volver a consultar y renderizar.
+    """
+    fase = obtener_fase_actual(conn)
+    huellas = calcular_huellas(conn, fase)
+    entorno = huella_entorno(opciones)
+    estado = cargar_estado_origen()
+    codes = [m["code"] for m in municipios]
+
+    plan = {"fase": fase, "huellas": huellas, "entorno": entorno,
+            "flags_previas": (estado or {}).get("flags", {}), "completo": False, "pendientes": {}}
+
+    if not estado or estado.get("fase") != fase or estado.get("entorno") != entorno:
+        print(" Sin estado previo válido (o cambió la fase/plantillas): se regenera todo.")
+        plan["completo"] = True
+        plan["pendientes"] = {c: list(FORMULARIOS) for c in codes}
+    else:
+        anteriores = estado.get("huellas", {})
+        for c in codes:
+            flags_prev = plan["flags_previas"].get(c)
+            for form in FORMULARIOS:
+                movido = any(huellas.get(f"{c}|{d}") != anteriores.get(f"{c}|{d}") for d in DEPENDENCIAS[form])
+                # Página que debería existir y no está (borrada a mano, etc.)
+                esperada = form in FORMULARIOS_FIJOS or (flags_prev or {}).get(form)
+                falta = esperada and not os.path.exists(os.path.join(OUTPUT_DIR, f"{form}_{c}.html"))
+                if movido or falta or flags_prev is None:
+                    plan["pendientes"].setdefault(c, []).append(form)
+
+    plan["por_conjunto"] = conjuntos_pendientes(plan["pendientes"])
+
+    n_pares = sum(len(f) for f in plan["pendientes"].values())
+    print(f" Cambios en origen: {n_pares} formularios de {len(plan['pendientes'])} municipios por regenerar.")
+    return plan
+
+# --- EQUIPAMIENTOS EN DIFERIDO (--equip-lazy) ---
+# La página lleva solo el esqueleto de cada categoría; las filas van en un JSON compacto
+# por categoría (docs/data/equipamientos_<mun>/<categoría>.json) que el navegador carga
+# al desplegarla (js/eiel-equip-lazy.js).
+EQUIP_LAZY_CAMPOS = ["cod", "nombre", "estado_txt", "url_foto", "url_visor", "url_miniatura"]
+
+def _slug(texto):
+    texto = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", "-", texto.lower()).strip("-")
+
+def equip_en_diferido(equip, equip_lazy):
+    # Con --equip-lazy, la página sale en diferido si pasa del umbral de filas
+    return equip_lazy is not None and filas_equipamientos(equip) > equip_lazy["filas"]
+
+def filas_equipamientos(equip):
+    return len(equip["sin_uso"]) + sum(len(l) for l in equip["general"].values())
+
+def ficheros_equip_lazy(code, equip):
+    """{categoría: (fichero, JSON)} con las filas de cada categoría, tal y como las pinta la plantilla."""
+    grupos = list(equip["general"].items())
+    if equip["sin_uso"]:
+        grupos.append(('EDIFICIO SIN USO', equip["sin_uso"]))
+    ficheros = {}
+    for categoria, lista in grupos:
+        filas = [[str(r["cod"]), str(r["nombre"]), str(r["estado_txt"]), r["url_foto"] or "", str(r["url_visor"]),
+                  r.get("url_miniatura", "")]
+                 for r in lista]
+        ficheros[categoria] = (f"data/equipamientos_{code}/{_slug(categoria)}.json",
+                               json.dumps({"campos": EQUIP_LAZY_CAMPOS, "filas": filas},
+                                          ensure_ascii=False, separators=(",", ":")))
+    return ficheros
+
+def pagina_de_datos(nombre):
+    # "data/equipamientos_014/parque.json" -> "equipamientos_014.html" (None si no es un fichero de datos)
+    m = re.match(r"^data/([a-z]+_\w+)/", nombre)
+    return f"{m.group(1)}.html" if m else None
+
+# --- RENDER DE UN MUNICIPIO ---
+def renderizar_municipio(escribir, m, datos, formularios=None, equip_lazy=None):
+    """
+    Renderiza los formularios de un municipio (todos, o solo los de `formularios`)
+    leyendo de los índices precargados y entrega cada página a
+    escribir(nombre, plantilla, contexto), que decide si renderiza de una vez o en stream.
+    Con equip_lazy ({"filas": umbral, "pagina": filas por página}) la página de
+    equipamientos con más de `umbral` filas sale en diferido (esqueleto + JSON).
+    Devuelve las banderas de los formularios bajo demanda que se han evaluado.
+    """
+    code = m["code"]       # Código del TSV (= código en BD)
+    name_display = m["name_bonito"] 
     
-    # Mapeo de iconos de Lucide para cada categoría
-    iconos = {
-        'CASA CONSISTORIAL': 'landmark', 'CENTRO CULTURAL': 'library', 'CENTRO ASISTENCIAL': 'heart-pulse',
-        'CENTRO ENSEÑANZA': 'graduation-cap', 'CENTRO SANITARIO': 'hospital', 'EDIFICIO SIN USO': 'door-closed',
-        'INSTALACIÓN DEPORTIVA': 'volleyball', 'MERCADO/LONJA': 'shopping-cart', 'PARQUE': 'tree-pine',
-        'PROTECCIÓN CIVIL': 'shield-alert', 'TANATORIO': 'flower-2'
-    }
+    fase_actual = datos["fase"]
+    config = configuracion()
     
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute(sql, (mun,) * 11)
-        res = cur.fetchall()
-        
-        agrupados = {}
-        edificios_sin_uso = []
-        
-        for r in res:
-            r_dict = dict(r)
-            r_dict['icono'] = iconos.get(r['tabla'], 'building')
-            
-            if r['tabla'] == 'EDIFICIO SIN USO':
-                edificios_sin_uso.append(r_dict)
+    common_ctx = {
+        "muni_code": code, 
+        "muni_display": name_display,
+        "url_adjuntos": config["url_adjuntos"],
+        "url_adjuntos_worker": config["url_adjuntos_worker"],
+        "url_generar_pdf": config["url_generar_pdf"],
+        "url_logger": config["url_logger"],
+        "fase_anterior": fase_actual - 1,
+        "fase_actual": fase_actual
+    }
+
+    flags = {}
+    for form, registro in REGISTRO_FORMULARIOS.items():
+        if formularios is not None and form not in formularios:
+            continue
+        avisos = avisos_de(datos, code, form)
+        if registro["condicion"] is not None:
+            flags[form] = registro["condicion"](datos, code, avisos)
+            if not flags[form]:
+                continue
+        escribir(f'{form}_{code}.html', cargar_plantilla(registro["plantilla"]), dict(
+            **common_ctx,
+            **registro["contexto"](datos, code, escribir, equip_lazy),
+            avisos_personalizados=avisos
+        ))
+
+    return flags
+
+def flags_municipio(previas, nuevas):
+    # Orden fijo de claves: el index.html no cambia si las banderas no cambian
+    return {k: bool(nuevas.get(k, previas.get(k, False))) for k in ('alumbrado', 'viario', 'saneamiento', 'cementerios')}
+
+PATRON_FLAGS_INDEX = re.compile(r"const MUNICIPIOS_FLAGS = (\{.*?\});")
+
+def flags_de_index():
+    """Banderas {code: {form: bool}} del docs/index.html publicado (None si no existe o no se entiende)."""
+    try:
+        with open(os.path.join(OUTPUT_DIR, "index.html"), encoding="utf-8") as f:
+            m = PATRON_FLAGS_INDEX.search(f.read())
+        return json.loads(m.group(1)) if m else None
+    except (OSError, ValueError):
+        return None
+
+def renderizar_index(salida, fase_actual, config_municipios_js):
+    with medir("*", "index", "render"):
+        html = cargar_plantilla(TEMPLATE_INDEX).render(
+            fase_actual=fase_actual,
+            municipios_lista=json.dumps(municipios_ui(), ensure_ascii=False),
+            # Pasamos el mapa de flags al JavaScript del Index
+            config_flags_json=json.dumps(config_municipios_js, ensure_ascii=False), 
+            url_login_api=configuracion()["url_login_script"]
+        )
+    escribir_salida(salida, "index.html", html)
+
+# --- MINIATURAS DE LAS FOTOS DE EQUIPAMIENTOS (--miniaturas) ---
+# Cada foto se descarga una vez por (capa, idu), se reduce con PIL y se guarda en una
+# caché en disco (.build/miniaturas) con su índice; a docs/img/eq/ se publican las que
+# usa la generación, con el hash del contenido en el nombre.
+MINIATURAS_DIR = os.path.join(BUILD_DIR, "miniaturas")
+MINIATURAS_INDICE = os.path.join(MINIATURAS_DIR, "indice.json")
+MINIATURAS_SALIDA = "img/eq"
+def descargar_foto(url, timeout=20):
+    """
+    Descarga por defecto (urllib). Devuelve los bytes, o None si el visor no tiene
+    foto; los errores de red se propagan (no se guardan como "sin foto").
+    """
+    import urllib.request, urllib.error  # solo hace falta con --miniaturas
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as r:
+            return r.read()
+    except urllib.error.HTTPError as e:
+        if e.code in (404, 410):
+            return None
+        raise
+
+def abrir_miniaturas(descargar, lado=120, formato="webp", caducidad_dias=30, refrescar=False, hilos=8, url=None):
+    """
+    Estado de las miniaturas de una generación. `descargar(url)` devuelve los bytes de la
+    foto o None si no la hay (descargar_foto, o un doble en pruebas y en el banco).
+    """
+    # Pillow solo se importa con --miniaturas
+    from PIL import features
+    if url is None:
+        # URL_FOTOS_EQUIP en .env ({capa}, {idu}); sin ella se descarga url_foto
+        url = configuracion()["url_fotos_equip"]
+    if formato == "webp" and not features.check("webp"):
+        print("⚠️ AVISO: esta instalación de Pillow no escribe WebP; las miniaturas van en JPEG.")
+        formato = "jpeg"
+    indice = {}
+    if os.path.exists(MINIATURAS_INDICE):
+        try:
+            with open(MINIATURAS_INDICE, "r", encoding="utf-8") as f:
+                indice = json.load(f)
+        except (ValueError, OSError) as e:
+            print(f"⚠️ AVISO: índice de miniaturas ilegible ({e}); se vuelven a descargar.")
+    return {"opciones": {"lado": lado, "formato": formato}, "caducidad": caducidad_dias * 86400,
+            "refrescar": refrescar, "hilos": hilos, "url": url, "descargar": descargar,
+            "indice": indice, "usadas": set(), "vistas": set(), "lock": threading.Lock(), "ultimo_fallo": None,
+            "cuenta": {"nuevas": 0, "reutilizadas": 0, "sin_foto": 0, "fallos": 0}}
+
+def _reducir_foto(mins, crudo):
+    from PIL import Image
+    imagen = Image.open(BytesIO(crudo))
+    imagen.thumbnail((mins["opciones"]["lado"], mins["opciones"]["lado"]))
+    if imagen.mode not in ("RGB", "L"):
+        imagen = imagen.convert("RGB")
+    salida = BytesIO()
+    if mins["opciones"]["formato"] == "webp":
+        imagen.save(salida, "WEBP", quality=70, method=4)
+    else:
+        imagen.save(salida, "JPEG", quality=75, optimize=True, progressive=True)
+    return salida.getvalue()
+
+def _miniatura(mins, capa, idu, url_foto):
+    """
+    Entrada del índice para (capa, idu): {"fichero": nombre o None si no hay foto, ...}.
+    Se reutiliza mientras no caduque ni cambien lado/formato; None si la descarga falla
+    y no hay nada previo.
+    """
+    clave = f"{capa}_{idu}"
+    with mins["lock"]:
+        mins["vistas"].add(clave)
+    previa = mins["indice"].get(clave)
+    vigente = (previa is not None and not mins["refrescar"]
+               and previa.get("opciones") == mins["opciones"]
+               and time.time() - previa.get("fecha", 0) < mins["caducidad"]
+               and (previa["fichero"] is None or os.path.exists(os.path.join(MINIATURAS_DIR, previa["fichero"]))))
+    if vigente:
+        with mins["lock"]:
+            mins["cuenta"]["reutilizadas"] += 1
+        return previa
+
+    from PIL import UnidentifiedImageError
+    url = mins["url"].format(capa=capa, idu=idu) if mins["url"] else url_foto
+    try:
+        crudo = mins["descargar"](url)
+        miniatura = _reducir_foto(mins, crudo) if crudo else None
+    except UnidentifiedImageError:
+        miniatura = None  # el visor devuelve algo que no es una imagen: sin foto
+    except Exception as e:
+        with mins["lock"]:
+            mins["cuenta"]["fallos"] += 1
+            mins["ultimo_fallo"] = f"{clave}: {e}"
+        # Mejor una miniatura algo antigua que ninguna
+        return previa if previa is not None and previa.get("opciones") == mins["opciones"] else None
+
+    fichero = None
+    if miniatura is not None:
+        ext = "webp" if mins["opciones"]["formato"] == "webp" else "jpg"
+        fichero = f"{clave}_{hashlib.sha256(miniatura).hexdigest()[:10]}.{ext}"
+        ruta = os.path.join(MINIATURAS_DIR, fichero)
+        if not os.path.exists(ruta):
+            with open(ruta, "wb") as f:
+                f.write(miniatura)
+    entrada = {"fichero": fichero, "fecha": int(time.time()), "opciones": mins["opciones"]}
+    with mins["lock"]:
+        mins["indice"][clave] = entrada
+        mins["cuenta"]["nuevas" if fichero else "sin_foto"] += 1
+    if previa and previa.get("fichero") not in (None, fichero):
+        try:
+            os.remove(os.path.join(MINIATURAS_DIR, previa["fichero"]))
+        except OSError:
+            pass
+    return entrada
+
+def miniaturas_equipamientos(mins, equipamientos):
+    """
+    Asegura la miniatura de cada fila del índice {mun: equipamientos} y la anota en
+    la fila: url_miniatura si la hay; url_foto vacía si el visor no tiene foto (la
+    plantilla pinta el hueco sin pedir nada). Si la descarga falla, la fila se queda
+    como estaba.
+    """
+    filas = [r for equip in equipamientos.values()
+             for r in itertools.chain(equip["sin_uso"], *equip["general"].values()) if r.get("url_foto")]
+    claves = list(dict.fromkeys((r["capa"], r["idu"], r["url_foto"]) for r in filas))
+    if not claves:
+        return
+    os.makedirs(MINIATURAS_DIR, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=mins["hilos"]) as pool:
+        entradas = dict(zip(claves, pool.map(lambda c: _miniatura(mins, *c), claves)))
+    for r in filas:
+        entrada = entradas[(r["capa"], r["idu"], r["url_foto"])]
+        if entrada is None:
+            continue
+        if entrada["fichero"] is None:
+            r["url_foto"] = ""
+        else:
+            r["url_miniatura"] = f"{MINIATURAS_SALIDA}/{entrada['fichero']}"
+            with mins["lock"]:
+                mins["usadas"].add(entrada["fichero"])
+
+def publicar_miniaturas(mins, podar=True):
+    """
+    Copia a docs/img/eq/ las miniaturas usadas que aún no están (el nombre lleva el
+    hash, así que basta con que exista) y, si `podar`, quita las que ya no se usan, en
+    docs/ y en la caché (.build/miniaturas). Guarda el índice de la caché.
+    """
+    destino = os.path.join(OUTPUT_DIR, *MINIATURAS_SALIDA.split("/"))
+    os.makedirs(destino, exist_ok=True)
+    copiadas = 0
+    for fichero in sorted(mins["usadas"]):
+        if not os.path.exists(os.path.join(destino, fichero)):
+            shutil.copy2(os.path.join(MINIATURAS_DIR, fichero), os.path.join(destino, fichero))
+            copiadas += 1
+    podadas = 0
+    os.makedirs(MINIATURAS_DIR, exist_ok=True)
+    if podar:
+        for fichero in os.listdir(destino):
+            if fichero not in mins["usadas"]:
+                os.remove(os.path.join(destino, fichero))
+                podadas += 1
+        # Entidades que ya no están (o sin equipamientos con foto) y ficheros huérfanos de la caché
+        for clave in [c for c in mins["indice"] if c not in mins["vistas"]]:
+            del mins["indice"][clave]
+        enlazados = {e["fichero"] for e in mins["indice"].values()}
+        for fichero in os.listdir(MINIATURAS_DIR):
+            if fichero != os.path.basename(MINIATURAS_INDICE) and fichero not in enlazados:
+                os.remove(os.path.join(MINIATURAS_DIR, fichero))
+    with open(MINIATURAS_INDICE, "w", encoding="utf-8") as f:
+        json.dump(mins["indice"], f, ensure_ascii=False, indent=0, sort_keys=True)
+    c = mins["cuenta"]
+    print(f" Miniaturas: {c['nuevas']} nuevas, {c['reutilizadas']} de la caché, {c['sin_foto']} sin foto, "
+          f"{c['fallos']} fallos; {copiadas} publicadas y {podadas} retiradas de docs/{MINIATURAS_SALIDA}.")
+    if c["fallos"]:
+        print(f"⚠️ AVISO: {c['fallos']} fotos no se han podido descargar (se enlaza la original); "
+              f"la última: {mins['ultimo_fallo']}")
+
+# --- RENDER EN PARALELO Y POR FRAGMENTOS (--workers / --shard) ---
+SHARDS_DIR = os.path.join(BUILD_DIR, "shards")
+
+def datos_para(datos, code, formularios):
+    # Solo viaja al proceso hijo lo que necesitan esos formularios de ese municipio
+    dependencias = [d.split(":") for form in formularios for d in DEPENDENCIAS[form]]
+    conjuntos = {d[0] for d in dependencias}
+    sub = {"fase": datos["fase"]}
+    for conjunto in CARGADORES:
+        if conjunto not in conjuntos:
+            sub[conjunto] = {}
+        elif conjunto == "avisos":
+            # Acceso directo por (mun, tipo): recorrer todos los avisos por trabajo es cuadrático
+            claves = {(code, d[1]) for d in dependencias if d[0] == "avisos"}
+            sub[conjunto] = {k: datos[conjunto][k] for k in claves if k in datos[conjunto]}
+        else:
+            sub[conjunto] = {code: datos[conjunto][code]} if code in datos[conjunto] else {}
+    return sub
+
+def filas_formulario(datos, code, form, equip_lazy=None):
+    """Filas de datos que lleva en línea la página de `form`: las de sus conjuntos y sus avisos."""
+    filas = 0
+    for d in DEPENDENCIAS[form]:
+        conjunto, _, tipo = d.partition(":")
+        if conjunto == "avisos":
+            filas += len(avisos_de(datos, code, tipo))
+        elif conjunto == "equipamientos":
+            equip = datos["equipamientos"].get(code, equipamientos_vacios())
+            if not equip_en_diferido(equip, equip_lazy):  # en diferido van en los JSON
+                filas += filas_equipamientos(equip)
+        else:
+            filas += len(datos[conjunto].get(code, []))
+    return filas
+
+def _renderizar_trabajo(trabajo):
+    m, datos_mun, formularios, equip_lazy = trabajo
+    paginas = []
+
+    def renderizar(nombre, plantilla, ctx):
+        t0 = time.perf_counter()
+        html = plantilla.render(**ctx)
+        # Las filas solo se anotan en las páginas (no en los JSON de --equip-lazy)
+        filas = filas_formulario(datos_mun, m["code"], _clave_pagina(nombre)[1], equip_lazy) if nombre.endswith(".html") else None
+        paginas.append((nombre, html, time.perf_counter() - t0, filas))
+
+    flags = renderizar_municipio(renderizar, m, datos_mun, formularios, equip_lazy)
+    return m["code"], paginas, flags
+
+def volcar_paginas(salida, paginas):
+    # Escribe lo que devuelve _renderizar_trabajo (anotando el tiempo de render en el perfil)
+    for nombre, html, segundos, filas in paginas:
+        mun, form = _clave_pagina(nombre)
+        registrar_medida(mun, form, "render", segundos, filas=filas)
+        escribir_salida(salida, nombre, html)
+
+# Trabajos en vuelo por worker: pool.map los encola todos de golpe y, con cientos de
+# municipios, las páginas ya renderizadas se acumulan en memoria esperando al escritor.
+VENTANA_POR_WORKER = 4
+
+def mapa_acotado(pool, funcion, trabajos, workers):
+    """
+    Como pool.map, pero con a lo sumo VENTANA_POR_WORKER × workers trabajos pendientes.
+    Los resultados salen en el orden de entrada.
+    """
+    pendientes = collections.deque()
+    for trabajo in trabajos:
+        if len(pendientes) >= VENTANA_POR_WORKER * workers:
+            yield pendientes.popleft().result()
+        pendientes.append(pool.submit(funcion, trabajo))
+    while pendientes:
+        yield pendientes.popleft().result()
+
+def renderizar_trabajos(salida, trabajos, workers=1):
+    """
+    Renderiza los trabajos (municipio, datos, formularios, equip_lazy) en serie o en un pool de
+    procesos. Los resultados se consumen en el orden de entrada, así que la salida
+    es idéntica a la de una ejecución en serie. Devuelve {code: banderas}.
+    """
+    flags = {}
+    if workers <= 1:
+        resultados = map(_renderizar_trabajo, trabajos)
+        for code, paginas, f in resultados:
+            volcar_paginas(salida, paginas)
+            flags.setdefault(code, {}).update(f)
+        return flags
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for code, paginas, f in mapa_acotado(pool, _renderizar_trabajo, trabajos, workers):
+            volcar_paginas(salida, paginas)
+            flags.setdefault(code, {}).update(f)
+    return flags
+
+def parsear_shard(valor):
+    try:
+        i, n = (int(x) for x in valor.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"formato esperado i/n (p. ej. 2/4), recibido {valor!r}")
+    if not (1 <= i <= n):
+        raise argparse.ArgumentTypeError(f"fragmento fuera de rango: {valor!r}")
+    return i, n
+
+def parsear_lista(valor):
+    # "014, 065" -> ["014", "065"]
+    elementos = [x.strip() for x in valor.split(",") if x.strip()]
+    if not elementos:
+        raise argparse.ArgumentTypeError(f"lista vacía: {valor!r}")
+    return elementos
+
+def municipios_del_shard(municipios, shard):
+    # Reparto determinista por código (no por nombre), alternando para equilibrar carga
+    if shard is None:
+        return list(municipios)
+    i, n = shard
+    codigos = sorted(m["code"] for m in municipios)
+    propios = {c for idx, c in enumerate(codigos) if idx % n == i - 1}
+    return [m for m in municipios if m["code"] in propios]
+
+def guardar_flags_shard(directorio, shard, fase, flags):
+    os.makedirs(directorio, exist_ok=True)
+    i, n = shard
+    ruta = os.path.join(directorio, f"flags-{i}-de-{n}.json")
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump({"fase": fase, "shard": [i, n], "flags": flags}, f, ensure_ascii=False, indent=1)
+    print(f" Banderas del fragmento {i}/{n} guardadas en {ruta}")
+
+def fusionar_flags_shards(directorio):
+    """
+    Junta las banderas de todos los fragmentos (flags-*-de-N.json) en el orden de
+    municipios_ui(). El total N y la fase son los del fragmento guardado más tarde: los
+    ficheros de ejecuciones anteriores con otro N u otra fase se ignoran. Falla si falta
+    algún fragmento.
+    """
+    ficheros = sorted(n for n in os.listdir(directorio) if re.match(r"^flags-\d+-de-\d+\.json$", n))
+    if not ficheros:
+        raise RuntimeError(f"No hay ficheros de banderas de fragmentos en {directorio}")
+    partes = []
+    for nombre in ficheros:
+        ruta = os.path.join(directorio, nombre)
+        with open(ruta, "r", encoding="utf-8") as f:
+            partes.append((os.path.getmtime(ruta), nombre, json.load(f)))
+    _, _, ultima = max(partes, key=lambda p: p[0])
+    n, fase = ultima["shard"][1], ultima["fase"]
+    ignorados = [nombre for _, nombre, p in partes if p["shard"][1] != n or p["fase"] != fase]
+    if ignorados:
+        print(f" Se ignoran {len(ignorados)} ficheros de banderas de otras ejecuciones "
+              f"(no son de {n} fragmentos de la fase {fase}): {', '.join(ignorados)}")
+    partes = [p for _, _, p in partes if p["shard"][1] == n and p["fase"] == fase]
+    faltan = set(range(1, n + 1)) - {p["shard"][0] for p in partes}
+    if faltan:
+        raise RuntimeError(f"Faltan los fragmentos {sorted(faltan)} de {n} de la fase {fase}")
+
+    todas = {}
+    for p in partes:
+        todas.update(p["flags"])
+    flags = {m["code"]: todas[m["code"]] for m in municipios_ui() if m["code"] in todas}
+    return fase, flags
+
+# --- MODO DE BAJO CONSUMO DE MEMORIA (--bajo-consumo) ---
+def renderizar_bajo_consumo(salida, conn, municipios, fase, pendientes, por_conjunto=None, itersize=200, equip_lazy=None,
+                            miniaturas=None):
+    """
+    Render en serie con la memoria acotada: cada página se vuelca en stream al
+    fichero y los equipamientos se leen de un cursor en el servidor, municipio a
+    municipio, en lugar de precargarlos todos. Devuelve {code: banderas}.
+    """
+    def escribir(nombre, plantilla, ctx):
+        trozos = plantilla.stream(**ctx)
+        trozos.enable_buffering(32)
+        escribir_salida_stream(salida, nombre, trozos)
+
+    codes = {m["code"] for m in municipios if pendientes.get(m["code"])}
+    pedir = dict(por_conjunto) if por_conjunto is not None else {conjunto: codes for conjunto in CARGADORES}
+    pedir["equipamientos"] = set()
+    datos = cargar_datos(conn, fase=fase, por_conjunto=pedir)
+
+    flags = {}
+    for m in municipios:
+        resto = [form for form in pendientes.get(m["code"], []) if form != 'equipamientos']
+        if resto:
+            flags.setdefault(m["code"], {}).update(renderizar_municipio(escribir, m, datos, resto))
+
+    por_code = {m["code"]: m for m in municipios}
+    con_equip = sorted(c for c in codes if 'equipamientos' in pendientes[c])
+    if con_equip:
+        vistos = set()
+        for mun, equip in iterar_equipamientos(conn, fase, con_equip, itersize):
+            vistos.add(mun)
+            datos["equipamientos"] = {mun: equip}
+            if miniaturas is not None:
+                miniaturas_equipamientos(miniaturas, datos["equipamientos"])
+            renderizar_municipio(escribir, por_code[mun], datos, ['equipamientos'], equip_lazy)
+        # Municipios sin ningún equipamiento: página con el listado vacío
+        datos["equipamientos"] = {}
+        for c in con_equip:
+            if c not in vistos:
+                renderizar_municipio(escribir, por_code[c], datos, ['equipamientos'], equip_lazy)
+    return flags
+
+# --- EJECUCIÓN EN TUBERÍA: CONSULTA → RENDER → ESCRITURA (--pipeline) ---
+_FIN = object()
+
+class _Cancelado(Exception):
+    pass
+
+def _poner(cola, item, parar):
+    # put con espera acotada para no quedarse bloqueado si otra etapa ha fallado
+    while True:
+        if parar.is_set():
+            raise _Cancelado()
+        try:
+            cola.put(item, timeout=0.2)
+            return
+        except queue.Full:
+            continue
+
+def _sacar(cola, parar):
+    while True:
+        if parar.is_set():
+            raise _Cancelado()
+        try:
+            return cola.get(timeout=0.2)
+        except queue.Empty:
+            continue
+
+def ejecutar_pipeline(salida, municipios, fase, pendientes, por_conjunto=None, workers=1, conexiones=3, lote=10, capacidad=4,
+                      equip_lazy=None, miniaturas=None):
+    """
+    Solapa consultas, render y escritura en tres etapas unidas por colas acotadas:
+    `conexiones` hilos consultan lotes de `lote` municipios (una conexión cada uno),
+    el hilo principal renderiza (o reparte en `workers` procesos) y un hilo escritor
+    vuelca las páginas. Las colas de tamaño `capacidad` frenan a la etapa rápida, así
+    que la memoria no crece con el número de municipios. Devuelve {code: banderas}.
+    """
+    activos = [m for m in municipios if pendientes.get(m["code"])]
+    lotes = queue.Queue()
+    for i in range(0, len(activos), lote):
+        lotes.put(activos[i:i + lote])
+
+    cola_render = queue.Queue(maxsize=capacidad)
+    cola_escritura = queue.Queue(maxsize=capacidad * lote)
+    parar = threading.Event()
+    errores = []
+    ocupado = {"consulta": 0.0, "render": 0.0, "escritura": 0.0}
+    cerrojo = threading.Lock()
+    flags = {}
+
+    def consultar():
+        conn = None
+        try:
+            conn = conectar()
+            while True:
+                try:
+                    grupo = lotes.get_nowait()
+                except queue.Empty:
+                    break
+                t0 = time.perf_counter()
+                codes = {m["code"] for m in grupo}
+                if por_conjunto is None:
+                    pedir = {conjunto: codes for conjunto in CARGADORES}
+                else:
+                    pedir = {conjunto: set(muns) & codes for conjunto, muns in por_conjunto.items()}
+                datos = cargar_datos(conn, fase=fase, por_conjunto=pedir, informar=False)
+                if miniaturas is not None:
+                    miniaturas_equipamientos(miniaturas, datos["equipamientos"])
+                with cerrojo:
+                    ocupado["consulta"] += time.perf_counter() - t0
+                _poner(cola_render, (grupo, datos), parar)
+        except _Cancelado:
+            pass
+        except Exception as e:
+            errores.append(e)
+            parar.set()
+        finally:
+            if conn: conn.close()
+            try:
+                _poner(cola_render, _FIN, parar)
+            except _Cancelado:
+                pass
+
+    def escribir():
+        try:
+            while True:
+                item = _sacar(cola_escritura, parar)
+                if item is _FIN:
+                    return
+                code, paginas, f = item
+                t0 = time.perf_counter()
+                volcar_paginas(salida, paginas)
+                flags.setdefault(code, {}).update(f)
+                ocupado["escritura"] += time.perf_counter() - t0
+        except _Cancelado:
+            pass
+        except Exception as e:
+            errores.append(e)
+            parar.set()
+
+    inicio = time.perf_counter()
+    n_consultas = max(1, min(conexiones, lotes.qsize()))
+    hilos = [threading.Thread(target=consultar, name=f"consulta-{i}", daemon=True) for i in range(n_consultas)]
+    escritor = threading.Thread(target=escribir, name="escritura", daemon=True)
+    for h in hilos + [escritor]:
+        h.start()
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        terminados = 0
+        while terminados < n_consultas:
+            item = _sacar(cola_render, parar)
+            if item is _FIN:
+                terminados += 1
+                continue
+            grupo, datos = item
+            t0 = time.perf_counter()
+            trabajos = [(m, datos_para(datos, m["code"], [form]), [form], equip_lazy)
+                        for m in grupo for form in pendientes[m["code"]]]
+            resultados = mapa_acotado(pool, _renderizar_trabajo, trabajos, workers) if pool else map(_renderizar_trabajo, trabajos)
+            for resultado in resultados:
+                ocupado["render"] += time.perf_counter() - t0
+                _poner(cola_escritura, resultado, parar)
+                t0 = time.perf_counter()
+            ocupado["render"] += time.perf_counter() - t0
+        _poner(cola_escritura, _FIN, parar)
+    except _Cancelado:
+        pass
+    except BaseException:
+        parar.set()
+        raise
+    finally:
+        if pool: pool.shutdown()
+        escritor.join()
+        for h in hilos:
+            h.join()
+
+    if errores:
+        raise errores[0]
+
+    total = time.perf_counter() - inicio
+    print(f" Tubería: {len(activos)} municipios en {total:.1f} s "
+          f"({n_consultas} conexiones, lotes de {lote}, {max(workers, 1)} proceso(s) de render)")
+    for etapa, hilos_etapa in (("consulta", n_consultas), ("render", 1), ("escritura", 1)):
+        uso = ocupado[etapa] / (total * hilos_etapa) * 100 if total > 0 else 0
+        print(f"   {etapa:<10} {ocupado[etapa]:7.1f} s ocupada  ({uso:5.1f}% de utilización)")
+    return flags
+
+# --- INSTANTÁNEA DE DATOS (snapshot export / --from-snapshot) ---
+SNAPSHOT_FORMATO = "eiel-snapshot"
+SNAPSHOT_VERSION = 1
+
+def exportar_snapshot(datos, ruta):
+    """
+    Guarda en un único .json.gz todo lo que lee el generador de la BD (fase,
+    depósitos, obras, equipamientos con sus URLs ya calculadas, cementerios y avisos).
+    El gzip va sin fecha para que dos exportaciones de los mismos datos sean idénticas.
+    """
+    contenido = {
+        "formato": SNAPSHOT_FORMATO,
+        "version": SNAPSHOT_VERSION,
+        "fase": datos["fase"],
+        "conjuntos": {
+            conjunto: ({f"{mun}|{tipo}": v for (mun, tipo), v in datos[conjunto].items()}
+                       if conjunto == "avisos" else datos[conjunto])
+            for conjunto in CARGADORES
+        },
+    }
+    # default=str: numeric (Decimal) y similares se renderizan igual como texto
+    crudo = json.dumps(contenido, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    with open(ruta, "wb") as f:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=0) as gz:
+            gz.write(crudo)
+    return len(crudo)
+
+def leer_snapshot(ruta):
+    with gzip.open(ruta, "rt", encoding="utf-8") as f:
+        contenido = json.load(f)
+    if contenido.get("formato") != SNAPSHOT_FORMATO or contenido.get("version") != SNAPSHOT_VERSION:
+        raise RuntimeError(f"{ruta} no es una instantánea compatible "
+                           f"(formato {contenido.get('formato')!r}, versión {contenido.get('version')!r}; "
+                           f"se espera {SNAPSHOT_FORMATO!r} v{SNAPSHOT_VERSION})")
+    datos = {"fase": contenido["fase"]}
+    for conjunto in CARGADORES:
+        valores = contenido["conjuntos"].get(conjunto, {})
+        datos[conjunto] = ({tuple(k.split("|", 1)): v for k, v in valores.items()}
+                           if conjunto == "avisos" else valores)
+    return datos
+
+def comando_snapshot(args):
+    if args.accion == "export":
+        conn = conectar()
+        try:
+            datos = cargar_datos(conn, [m["code"] for m in municipios_ui()])
+        finally:
+            conn.close()
+        guardar_cache_visor()
+        n = exportar_snapshot(datos, args.fichero)
+        print(f" Instantánea de la fase {datos['fase']} guardada en {args.fichero} "
+              f"({n / 1024:.0f} KiB sin comprimir, {os.path.getsize(args.fichero) / 1024:.0f} KiB en disco).")
+        return 0
+
+    datos = leer_snapshot(args.fichero)
+    print(f" {args.fichero}: {SNAPSHOT_FORMATO} v{SNAPSHOT_VERSION}, fase {datos['fase']}")
+    for conjunto in CARGADORES:
+        filas = sum(len(v) if isinstance(v, list) else len(v["sin_uso"]) + sum(len(l) for l in v["general"].values())
+                    for v in datos[conjunto].values())
+        print(f"   {conjunto:<14} {len({k[0] if isinstance(k, tuple) else k for k in datos[conjunto]}):4} municipios, {filas:6} filas")
+    return 0
+
+# --- SERVIDOR BAJO DEMANDA (serve) ---
+# Renderiza cada página la primera vez que se pide, con las mismas plantillas y
+# cargadores, y la guarda en una caché LRU acotada en bytes con clave (form, mun, fase).
+RUTA_PAGINA = re.compile(r"^/([a-z]+)_(\w+)\.html$")
+DIRS_ESTATICOS = {"css": ASSETS_CSS_DIR, "js": ASSETS_JS_DIR, "assets": ASSETS_DIR}
+
+# Marca en la caché de un formulario que no aplica al municipio (404 sin volver a consultar)
+NO_DISPONIBLE = b""
+
+def nueva_cache(max_bytes):
+    return {"paginas": collections.OrderedDict(), "bytes": 0, "max_bytes": max_bytes,
+            "aciertos": 0, "fallos": 0, "lock": threading.Lock()}
+
+def cache_obtener(cache, clave):
+    with cache["lock"]:
+        contenido = cache["paginas"].get(clave)
+        if contenido is None:
+            cache["fallos"] += 1
+            return None
+        cache["paginas"].move_to_end(clave)
+        cache["aciertos"] += 1
+        return contenido
+
+def cache_guardar(cache, clave, contenido):
+    if len(contenido) > cache["max_bytes"]:
+        return
+    with cache["lock"]:
+        previo = cache["paginas"].pop(clave, None)
+        if previo is not None:
+            cache["bytes"] -= len(previo)
+        cache["paginas"][clave] = contenido
+        cache["bytes"] += len(contenido)
+        while cache["bytes"] > cache["max_bytes"]:
+            _, expulsado = cache["paginas"].popitem(last=False)
+            cache["bytes"] -= len(expulsado)
+
+def cache_invalidar(cache, mun=None, fase=None):
+    """
+    Quita de la caché las páginas de un municipio (y el index, por sus banderas),
+    las de una fase, o todas si no se indica nada. Devuelve cuántas se han quitado.
+    """
+    with cache["lock"]:
+        fuera = [k for k in cache["paginas"]
+                 if (mun is None or k[1] in (mun, "*")) and (fase is None or k[2] == fase)]
+        for k in fuera:
+            cache["bytes"] -= len(cache["paginas"].pop(k))
+        return len(fuera)
+
+def _datos_servidor(estado, codes, conjuntos):
+    # Datos recién leídos de la BD (o de la instantánea) solo para esos municipios y conjuntos
+    if estado["snapshot"] is not None:
+        return estado["snapshot"]
+    with estado["lock_bd"]:
+        try:
+            if estado["conn"] is None:
+                estado["conn"] = conectar()
+            conn = estado["conn"]
+            if estado["fase"] is None:
+                estado["fase"] = obtener_fase_actual(conn)
+            return cargar_datos(conn, fase=estado["fase"], por_conjunto={c: codes for c in conjuntos}, informar=False)
+        except psycopg2.Error:
+            # Conexión caída: se abre otra en la siguiente petición
+            if estado["conn"] is not None:
+                estado["conn"].close()
+            estado["conn"] = None
+            raise
+
+def fase_servidor(estado):
+    if estado["fase"] is None:
+        _datos_servidor(estado, [], [])
+    return estado["fase"]
+
+def renderizar_pagina(estado, form, code):
+    """HTML (bytes) de {form}_{code}.html, o None si ese formulario no aplica al municipio."""
+    conjuntos = {d.split(":")[0] for d in DEPENDENCIAS[form]}
+    datos = _datos_servidor(estado, [code], conjuntos)
+    paginas = {}
+    renderizar_municipio(lambda nombre, plantilla, ctx: paginas.__setitem__(nombre, plantilla.render(**ctx)),
+                         estado["municipios"][code], datos, [form])
+    html = paginas.get(f"{form}_{code}.html")
+    return html.encode("utf-8") if html is not None else None
+
+def renderizar_index_servidor(estado):
+    codes = list(estado["municipios"])
+    datos = _datos_servidor(estado, codes, {"cementerios", "avisos"})
+    config = {m["code"]: flags_municipio({}, renderizar_municipio(lambda *a: None, m, datos, FORMULARIOS_BAJO_DEMANDA))
+              for m in municipios_ui()}
+    return cargar_plantilla(TEMPLATE_INDEX).render(
+        fase_actual=datos["fase"],
+        municipios_lista=json.dumps(municipios_ui(), ensure_ascii=False),
+        config_flags_json=json.dumps(config, ensure_ascii=False),
+        url_login_api=configuracion()["url_login_script"]
+    ).encode("utf-8")
+
+def _responder(start_response, estado_http, cuerpo, tipo="text/html; charset=utf-8", cabeceras=(), sin_cuerpo=False):
+    start_response(estado_http, [("Content-Type", tipo), ("Content-Length", str(len(cuerpo))),
+                                 ("Cache-Control", "no-cache"), *cabeceras])
+    # HEAD: las mismas cabeceras (Content-Length incluido), sin el cuerpo
+    return [] if sin_cuerpo else [cuerpo]
+
+def _fichero_estatico(ruta):
+    # /css/..., /js/..., /assets/... desde las fuentes; el resto (p. ej. img/) desde docs/
+    partes = ruta.lstrip("/").split("/", 1)
+    base = DIRS_ESTATICOS.get(partes[0]) if len(partes) == 2 else None
+    base, relativa = (base, partes[1]) if base else (OUTPUT_DIR, ruta.lstrip("/"))
+    if base != OUTPUT_DIR:
+        # css/style.1a2b3c4d5e.css -> css/style.css (la fuente siempre es la versión vigente)
+        huella = PATRON_ASSET_HUELLA.match(relativa)
+        relativa = huella.group(1) + huella.group(3) if huella else relativa
+    fichero = os.path.normpath(os.path.join(base, relativa))
+    if not fichero.startswith(os.path.normpath(base) + os.sep) or not os.path.isfile(fichero):
+        return None
+    return fichero
+
+def _administrar(estado, entorno, start_response):
+    if estado["token"] and entorno.get("HTTP_X_TOKEN") != estado["token"]:
+        return _responder(start_response, "403 Forbidden", b"Token incorrecto\n", "text/plain; charset=utf-8")
+    cache = estado["cache"]
+    if entorno["PATH_INFO"] == "/_admin/invalidar" and entorno["REQUEST_METHOD"] == "POST":
+        consulta = urllib.parse.parse_qs(entorno.get("QUERY_STRING", ""))
+        mun = consulta.get("mun", [None])[0]
+        try:
+            fase = int(consulta["fase"][0]) if "fase" in consulta else None
+        except ValueError:
+            return _responder(start_response, "400 Bad Request", "fase debe ser un número entero\n".encode("utf-8"), "text/plain; charset=utf-8")
+        quitadas = cache_invalidar(cache, mun=mun, fase=fase)
+        if mun is None and estado["snapshot"] is None:
+            # Al invalidar una fase (o todo) se vuelve a preguntar cuál es la actual
+            estado["fase"] = None
+        print(f" Caché invalidada (mun={mun or '*'}, fase={fase or '*'}): {quitadas} páginas.")
+        cuerpo = {"invalidadas": quitadas}
+    elif entorno["PATH_INFO"] == "/_admin/estado":
+        cuerpo = {"fase": estado["fase"], "paginas": len(cache["paginas"]), "bytes": cache["bytes"],
+                  "max_bytes": cache["max_bytes"], "aciertos": cache["aciertos"], "fallos": cache["fallos"]}
+    else:
+        return _responder(start_response, "404 Not Found", b"No encontrado\n", "text/plain; charset=utf-8")
+    return _responder(start_response, "200 OK", json.dumps(cuerpo).encode("utf-8"), "application/json")
+
+def app_servidor(estado):
+    """Aplicación WSGI del modo serve sobre `estado` (ver comando_serve)."""
+    def app(entorno, start_response):
+        ruta = entorno.get("PATH_INFO") or "/"
+        if ruta.startswith("/_admin/"):
+            return _administrar(estado, entorno, start_response)
+        if entorno["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return _responder(start_response, "405 Method Not Allowed", b"", "text/plain")
+        head = entorno["REQUEST_METHOD"] == "HEAD"
+
+        m = RUTA_PAGINA.match(ruta)
+        es_index = ruta in ("/", "/index.html")
+        if es_index or (m and m.group(1) in FORMULARIOS and m.group(2) in estado["municipios"]):
+            try:
+                fase = fase_servidor(estado)
+                clave = ("index", "*", fase) if es_index else (m.group(1), m.group(2), fase)
+                contenido = cache_obtener(estado["cache"], clave)
+                origen = "HIT"
+                if contenido is None:
+                    origen = "MISS"
+                    contenido = renderizar_index_servidor(estado) if es_index else renderizar_pagina(estado, *clave[:2])
+                    # También se guarda que el formulario no aplica al municipio (NO_DISPONIBLE)
+                    cache_guardar(estado["cache"], clave, NO_DISPONIBLE if contenido is None else contenido)
+            except Exception as e:
+                print(f"❌ ERROR sirviendo {ruta}: {e}")
+                return _responder(start_response, "500 Internal Server Error", f"Error: {e}\n".encode("utf-8"),
+                                  "text/plain; charset=utf-8", sin_cuerpo=head)
+            if contenido is None or contenido == NO_DISPONIBLE:
+                return _responder(start_response, "404 Not Found", b"Formulario no disponible para este municipio\n",
+                                  "text/plain; charset=utf-8", cabeceras=[("X-Cache", origen)], sin_cuerpo=head)
+            return _responder(start_response, "200 OK", contenido, cabeceras=[("X-Cache", origen)], sin_cuerpo=head)
+
+        fichero = _fichero_estatico(ruta)
+        if fichero is None:
+            return _responder(start_response, "404 Not Found", b"No encontrado\n", "text/plain; charset=utf-8", sin_cuerpo=head)
+        with open(fichero, "rb") as f:
+            contenido = f.read()
+        return _responder(start_response, "200 OK", contenido, mimetypes.guess_type(fichero)[0] or "application/octet-stream",
+                          sin_cuerpo=head)
+    return app
+
+def comando_serve(args):
+    # wsgiref (http.server) solo se importa para servir
+    import socketserver
+    from wsgiref.simple_server import make_server, WSGIServer
+
+    class ServidorHilos(socketserver.ThreadingMixIn, WSGIServer):
+        daemon_threads = True
+
+    estado = {
+        "municipios": {m["code"]: m for m in municipios_ui()},
+        "cache": nueva_cache(int(args.cache_mb * 1024 * 1024)),
+        "snapshot": leer_snapshot(args.from_snapshot) if args.from_snapshot else None,
+        "fase": None, "conn": None, "lock_bd": threading.Lock(),
+        "token": args.token or configuracion()["serve_token"],
+    }
+    if estado["snapshot"] is not None:
+        estado["fase"] = estado["snapshot"]["fase"]
+    servidor = make_server(args.host, args.port, app_servidor(estado), server_class=ServidorHilos)
+    print(f" Sirviendo formularios bajo demanda en http://{args.host}:{args.port}/ "
+          f"(caché de {args.cache_mb:g} MB{', datos de ' + args.from_snapshot if args.from_snapshot else ''}).")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        if estado["conn"] is not None:
+            estado["conn"].close()
+        guardar_cache_visor()
+    return 0
+
+# --- MODO VIGILANCIA (--watch) ---
+# Tras una generación normal los datos leídos se quedan en memoria y se sondean los
+# mtimes de templates/, css/, js/ y assets/. Cada cambio regenera solo lo que depende
+# de él: las plantillas se relacionan por {% extends/include/import %} y con los assets
+# por asset('...') (el nombre con huella va en el HTML). Un asset que ninguna plantilla
+# enlaza solo se copia. Jinja recarga por su cuenta las plantillas modificadas.
+DIRS_VIGILADOS = {"templates": TEMPLATE_DIR, **DIRS_ASSETS}
+PATRON_ASSET_PLANTILLA = re.compile(r"""asset\(\s*['"]([^'"]+)['"]\s*\)""")
+
+def instantanea_fuentes():
+    """{(carpeta, ruta): (mtime_ns, tamaño)} de los ficheros vigilados."""
+    fuentes = {}
+    for carpeta, origen in DIRS_VIGILADOS.items():
+        for raiz, _, ficheros in os.walk(origen):
+            for nombre in ficheros:
+                ruta = os.path.join(raiz, nombre)
+                try:
+                    st = os.stat(ruta)
+                except OSError:
+                    continue  # borrado entre el listado y el stat
+                fuentes[(carpeta, ruta)] = (st.st_mtime_ns, st.st_size)
+    return fuentes
+
+def grafo_plantillas():
+    """
+    Devuelve ({plantilla: plantillas que la extienden/incluyen}, {asset: plantillas que lo enlazan}).
+    Una plantilla que no compila no aporta aristas (el error saldrá al renderizar).
+    """
+    env = entorno_jinja()
+    usan, enlazan = {}, {}
+    for nombre in env.list_templates(extensions=["j2"]):
+        fuente = env.loader.get_source(env, nombre)[0]
+        try:
+            referencias = meta.find_referenced_templates(env.parse(fuente))
+            for ref in referencias:
+                if ref is not None:
+                    usan.setdefault(ref, set()).add(nombre)
+        except TemplateSyntaxError:
+            pass
+        for rel in PATRON_ASSET_PLANTILLA.findall(fuente):
+            enlazan.setdefault(rel, set()).add(nombre)
+    return usan, enlazan
+
+def plantillas_afectadas(usan, cambiadas):
+    # Cierre transitivo: base.html.j2 -> form-*.html.j2 -> ...
+    afectadas, pendientes = set(), list(cambiadas)
+    while pendientes:
+        nombre = pendientes.pop()
+        if nombre not in afectadas:
+            afectadas.add(nombre)
+            pendientes.extend(usan.get(nombre, ()))
+    return afectadas
+
+def regenerar_afectadas(args, datos, municipios, pendientes, afectadas):
+    """Vuelve a renderizar las páginas (y el index) cuyas plantillas están en `afectadas`. Devuelve cuántas."""
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    equip_lazy = {"filas": args.equip_lazy_filas, "pagina": args.equip_lazy_pagina} if args.equip_lazy else None
+    forms = {f for f, r in REGISTRO_FORMULARIOS.items() if r["plantilla"] in afectadas}
+    trabajos = [(m, datos_para(datos, m["code"], [form]), [form], equip_lazy)
+                for m in municipios for form in pendientes[m["code"]] if form in forms]
+    if not trabajos and TEMPLATE_INDEX not in afectadas:
+        return 0
+    salida = abrir_salida(args.compactar)
+    renderizar_trabajos(salida, trabajos, workers)
+    ambito = {f"{form}_{m['code']}.html" for m, _, (form,), _ in trabajos}
+    if TEMPLATE_INDEX in afectadas:
+        # Los datos no cambian en --watch: las banderas son las de la generación inicial
+        previas = flags_de_index() or {}
+        pedidos = {f for fs in pendientes.values() for f in fs}
+        bajo_demanda = [f for f in FORMULARIOS_BAJO_DEMANDA if f in pedidos]
+        banderas = dict(previas)
+        for m in municipios:
+            banderas[m["code"]] = flags_municipio(previas.get(m["code"], {}),
+                                                  renderizar_municipio(lambda *a: None, m, datos, bajo_demanda))
+        renderizar_index(salida, datos["fase"], banderas)
+        ambito.add("index.html")
+    ambito.update(n for n in salida["anterior"] if pagina_de_datos(n) in ambito)
+    cerrar_salida(salida, ambito, listar=False)
+    if args.precomprimir:
+        precomprimir_salida(salida["actual"])
+    return len(salida["nuevos"]) + len(salida["cambiados"]) + salida["sin_cambios"]
+
+def comando_watch(args, codigos=None, formularios=None, descargar=descargar_foto):
+    municipios = [m for m in municipios_ui() if codigos is None or m["code"] in codigos]
+    forms = [f for f in FORMULARIOS if formularios is None or f in formularios]
+    pendientes = {m["code"]: forms for m in municipios}
+    if args.from_snapshot:
+        datos = leer_snapshot(args.from_snapshot)
+        print(f" Datos leídos de la instantánea {args.from_snapshot} (sin BD).")
+    else:
+        if args.visor_refrescar:
+            vaciar_cache_visor()
+        conn = conectar()
+        try:
+            fase = obtener_fase_actual(conn)
+            if codigos is None and formularios is None:
+                datos = cargar_datos(conn, [m["code"] for m in municipios], fase=fase)
             else:
-                cat = r['tabla']
-                if cat not in agrupados: agrupados[cat] = []
-                agrupados[cat].append(r_dict)
-                
-        return {"general": agrupados, "sin_uso": edificios_sin_uso}
-        
-def main():
+                datos = cargar_datos(conn, fase=fase, por_conjunto=conjuntos_pendientes(pendientes))
+        finally:
+            conn.close()
+    ejecutar_generacion(args, codigos, formularios, datos=datos, descargar=descargar)
+
+    previas = instantanea_fuentes()
+    print("\n Vigilando templates/, css/, js/ y assets/ (Ctrl+C para terminar)...")
+    try:
+        while True:
+            time.sleep(args.watch_intervalo)
+            actuales = instantanea_fuentes()
+            if actuales == previas:
+                continue
+            cambiadas = {k for k in previas.keys() | actuales.keys() if previas.get(k) != actuales.get(k)}
+            previas = actuales
+            t0 = time.perf_counter()
+            try:
+                plantillas = {os.path.relpath(ruta, TEMPLATE_DIR).replace(os.sep, "/")
+                              for carpeta, ruta in cambiadas if carpeta == "templates"}
+                assets = {actualizar_asset(carpeta, ruta) for carpeta, ruta in cambiadas if carpeta != "templates"}
+                usan, enlazan = grafo_plantillas()
+                if assets:
+                    copiar_assets(assets)
+                enlazadas = {p for rel in assets for p in enlazan.get(rel, ())}
+                afectadas = plantillas_afectadas(usan, plantillas | enlazadas)
+                n = regenerar_afectadas(args, datos, municipios, pendientes, afectadas) if afectadas else 0
+                if assets and codigos is None and formularios is None:
+                    # Todas las páginas que enlazan esos assets se acaban de regenerar
+                    retirar_huellas_antiguas()
+                nombres = ", ".join(sorted(plantillas | assets))
+                print(f" [{time.strftime('%H:%M:%S')}] {nombres}: {n} páginas en {time.perf_counter() - t0:.2f} s")
+            except Exception as e:
+                # Una plantilla a medio editar no debe tirar la vigilancia
+                donde = f" ({e.filename}:{e.lineno})" if isinstance(e, TemplateSyntaxError) else ""
+                print(f" ❌ {type(e).__name__}{donde}: {e}")
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+# --- LÍNEA DE ÓRDENES Y API ---
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Genera los formularios EIEL (docs/) desde la BD y las plantillas.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Consulta y regenera solo los municipios/formularios cuyos datos han cambiado "
+                             "desde la última ejecución incremental (huellas en .build/).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Procesos de render en paralelo (0 = uno por núcleo; por defecto 1, en serie).")
+    parser.add_argument("--shard", type=parsear_shard, metavar="I/N",
+                        help="Genera solo el fragmento I de N de los municipios y guarda sus banderas "
+                             "para --merge-index (no genera index.html).")
+    parser.add_argument("--merge-index", action="store_true",
+                        help="Genera index.html juntando las banderas de todos los fragmentos (sin BD).")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Solapa consultas, render y escritura por lotes con colas acotadas.")
+    parser.add_argument("--conexiones", type=int, default=3,
+                        help="Conexiones (hilos de consulta) en modo --pipeline (por defecto 3).")
+    parser.add_argument("--lote", type=int, default=10,
+                        help="Municipios por consulta en modo --pipeline (por defecto 10).")
+    parser.add_argument("--bajo-consumo", action="store_true",
+                        help="Memoria acotada: render en stream a disco y equipamientos leídos con un "
+                             "cursor en el servidor, municipio a municipio.")
+    parser.add_argument("--itersize", type=int, default=200,
+                        help="Filas por viaje del cursor de equipamientos en --bajo-consumo (por defecto 200).")
+    parser.add_argument("--shards-dir", default=SHARDS_DIR,
+                        help=f"Carpeta de las banderas por fragmento (por defecto {os.path.relpath(SHARDS_DIR, BASE_DIR)}).")
+    parser.add_argument("--from-snapshot", metavar="FICHERO",
+                        help="Genera desde una instantánea (snapshot export) sin conectarse a la BD.")
+    parser.add_argument("--equip-lazy", action="store_true",
+                        help="Equipamientos en diferido: la página lleva el esqueleto y cada categoría se carga "
+                             "de un JSON (docs/data/) al desplegarla.")
+    parser.add_argument("--equip-lazy-filas", type=int, default=100, metavar="N",
+                        help="Con --equip-lazy, solo las páginas de más de N equipamientos (por defecto 100; 0 = todas).")
+    parser.add_argument("--equip-lazy-pagina", type=int, default=50, metavar="N",
+                        help="Con --equip-lazy, filas que se pintan de cada vez al desplegar (por defecto 50).")
+    parser.add_argument("--miniaturas", action="store_true",
+                        help="Descarga una vez cada foto de equipamiento, genera miniaturas (caché en .build/miniaturas) "
+                             "y las publica en docs/img/eq/; la foto completa solo se pide al pulsar.")
+    parser.add_argument("--miniaturas-lado", type=int, default=120, metavar="PX",
+                        help="Lado máximo de las miniaturas en píxeles (por defecto 120).")
+    parser.add_argument("--miniaturas-formato", choices=["webp", "jpeg"], default="webp",
+                        help="Formato de las miniaturas (por defecto webp).")
+    parser.add_argument("--miniaturas-caducidad", type=float, default=30, metavar="DIAS",
+                        help="Días tras los que se vuelve a descargar una foto de la caché (por defecto 30).")
+    parser.add_argument("--miniaturas-refrescar", action="store_true",
+                        help="Ignora la caché de miniaturas y vuelve a descargarlas todas.")
+    parser.add_argument("--miniaturas-hilos", type=int, default=8,
+                        help="Descargas de fotos en paralelo (por defecto 8).")
+    parser.add_argument("--visor-refrescar", action="store_true",
+                        help="Ignora la caché de coordenadas del visor (.build/visor-equipamientos.json) "
+                             "y vuelve a calcular todos los centroides de equipamientos.")
+    parser.add_argument("--precomprimir", action="store_true",
+                        help="Escribe .gz (y .br si está instalado brotli) junto a cada HTML/CSS/JS/JSON cuando ocupan menos.")
+    parser.add_argument("--compactar", action="store_true",
+                        help="Saca los scripts comunes a docs/compartido/*.js y minifica el HTML (informa de los bytes ahorrados).")
+    parser.add_argument("--mun", type=parsear_lista, metavar="COD[,COD...]",
+                        help="Genera solo estos municipios (códigos del TSV, separados por comas); "
+                             "el resto de docs/ no se toca.")
+    parser.add_argument("--form", type=parsear_lista, metavar="FORM[,FORM...]",
+                        help=f"Genera solo estos formularios ({', '.join(FORMULARIOS)}); el resto de docs/ no se toca.")
+    parser.add_argument("--watch", action="store_true",
+                        help="Tras generar, vigila templates/, css/, js/ y assets/ y regenera solo las páginas "
+                             "afectadas por cada cambio, con los datos ya leídos en memoria.")
+    parser.add_argument("--watch-intervalo", type=float, default=0.5, metavar="SEG",
+                        help="Con --watch, segundos entre comprobaciones (por defecto 0.5).")
+    parser.add_argument("--presupuesto", nargs="?", const=PRESUPUESTO_FILE, metavar="FICHERO.json",
+                        help="Comprueba al terminar los límites de peso por página, filas, tamaño de docs/ y segundos "
+                             f"por etapa (por defecto {os.path.relpath(PRESUPUESTO_FILE, BASE_DIR)}) y lista los excesos.")
+    parser.add_argument("--presupuesto-estricto", action="store_true",
+                        help="Con --presupuesto, sale con código 3 si se excede algún límite.")
+    parser.add_argument("--profile", metavar="FICHERO.json",
+                        help="Mide tiempos, filas y bytes por (municipio, formulario, etapa) y guarda el informe en JSON.")
+    parser.add_argument("--profile-top", type=int, default=10, metavar="N",
+                        help="Cuántos municipios/consultas/plantillas lentos listar con --profile (por defecto 10).")
+    parser.add_argument("--explain", action="store_true",
+                        help="Con --profile, añade EXPLAIN (ANALYZE, BUFFERS) de la consulta más lenta de cada conjunto.")
+    comandos = parser.add_subparsers(dest="comando")
+    p_snapshot = comandos.add_parser("snapshot", help="Exporta o inspecciona una instantánea de los datos de la BD.")
+    p_snapshot.add_argument("accion", choices=["export", "info"])
+    p_snapshot.add_argument("fichero", help="Fichero .json.gz de la instantánea")
+    p_serve = comandos.add_parser("serve", help="Sirve los formularios renderizándolos bajo demanda (con caché LRU).")
+    p_serve.add_argument("--host", default="127.0.0.1", help="Dirección de escucha (por defecto 127.0.0.1).")
+    p_serve.add_argument("--port", type=int, default=8000, help="Puerto (por defecto 8000).")
+    p_serve.add_argument("--cache-mb", type=float, default=64, help="Tamaño máximo de la caché de páginas en MB (por defecto 64).")
+    p_serve.add_argument("--token", help="Token exigido (cabecera X-Token) en /_admin/; también SERVE_TOKEN en .env.")
+    p_serve.add_argument("--from-snapshot", metavar="FICHERO", help="Sirve desde una instantánea en vez de la BD.")
+    return parser
+
+def validar_opciones(args):
+    if args.from_snapshot and (args.incremental or args.pipeline or args.bajo_consumo or args.visor_refrescar):
+        raise ValueError("--from-snapshot no usa la BD: no se combina con --incremental, --pipeline, "
+                         "--bajo-consumo ni --visor-refrescar")
+    if args.shard and args.incremental:
+        raise ValueError("--shard no es compatible con --incremental")
+    if args.bajo_consumo and (args.pipeline or args.workers != 1):
+        raise ValueError("--bajo-consumo renderiza en serie: no se combina con --pipeline ni --workers")
+    if args.merge_index and (args.mun is not None or args.form is not None):
+        raise ValueError("--merge-index solo genera index.html: no se combina con --mun ni --form")
+    if args.lote < 1:
+        raise ValueError("--lote debe ser al menos 1")
+    if args.presupuesto_estricto and not args.presupuesto:
+        raise ValueError("--presupuesto-estricto necesita --presupuesto")
+    if args.watch and (args.incremental or args.shard or args.merge_index or args.pipeline or args.bajo_consumo):
+        raise ValueError("--watch trabaja con los datos en memoria: no se combina con --incremental, "
+                         "--shard, --merge-index, --pipeline ni --bajo-consumo")
+
+def validar_seleccion(codigos, formularios):
+    if codigos is not None:
+        desconocidos = set(codigos) - {m["code"] for m in municipios_ui()}
+        if desconocidos:
+            raise ValueError(f"Municipios desconocidos: {', '.join(sorted(desconocidos))}")
+    if formularios is not None:
+        desconocidos = set(formularios) - set(FORMULARIOS)
+        if desconocidos:
+            raise ValueError(f"Formularios desconocidos: {', '.join(sorted(desconocidos))} "
+                             f"(disponibles: {', '.join(FORMULARIOS)})")
+
+def ejecutar_generacion(args, codigos=None, formularios=None, datos=None, descargar=descargar_foto):
+    """
+    Genera docs/ con las opciones de `args` (las de la línea de órdenes). Con `codigos`
+    y/o `formularios` solo se consultan y regeneran esas páginas: el resto de docs/ no se
+    toca, salvo las banderas de esos municipios en index.html si han cambiado. Con `datos`
+    (ya cargados, p. ej. en --watch) no se consulta nada.
+    Devuelve los cambios de la salida; los errores se propagan.
+    """
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    equip_lazy = {"filas": args.equip_lazy_filas, "pagina": args.equip_lazy_pagina} if args.equip_lazy else None
+    # Opciones que cambian el HTML de salida (entran en la huella del modo incremental)
+    opciones = {}
+    if equip_lazy:
+        opciones["equip_lazy"] = equip_lazy
+    if args.miniaturas:
+        opciones["miniaturas"] = {"lado": args.miniaturas_lado, "formato": args.miniaturas_formato}
+    if args.compactar:
+        opciones["compactar"] = True
+
+    if args.merge_index:
+        fase_actual, config_municipios_js = fusionar_flags_shards(args.shards_dir)
+        salida = abrir_salida(args.compactar)
+        print(f"Generando Index maestro ({len(config_municipios_js)} municipios)...")
+        renderizar_index(salida, fase_actual, config_municipios_js)
+        cambios = cerrar_salida(salida, {"index.html"})
+        # Con todos los fragmentos generados, ninguna página enlaza ya las huellas antiguas
+        retirar_huellas_antiguas()
+        if args.precomprimir:
+            precomprimir_salida(["index.html"])
+        return cambios
+
+    todos = municipios_ui()
+    validar_seleccion(codigos, formularios)
+    if codigos is not None:
+        codigos = set(codigos)
+    subconjunto = codigos is not None or formularios is not None
+    forms_pedidos = FORMULARIOS if formularios is None else [f for f in FORMULARIOS if f in formularios]
+
+    presupuesto = cargar_presupuesto(args.presupuesto) if args.presupuesto else None
+
     print("--- INICIO GENERACIÓN ---")
+    inicio = time.perf_counter()
+    if args.profile or presupuesto is not None:
+        # El presupuesto se comprueba con las filas y los tiempos del perfil
+        iniciar_perfil()
     if not os.path.exists(OUTPUT_DIR): os.makedirs(OUTPUT_DIR)
     copiar_assets()
+    if args.visor_refrescar and datos is None:
+        vaciar_cache_visor()
     
     conn = None
+    salida = abrir_salida(args.compactar)
+    municipios = municipios_del_shard(todos, args.shard)
+    if codigos is not None:
+        municipios = [m for m in municipios if m["code"] in codigos]
     
     # Diccionario para almacenar las banderas de cada municipio para el index.html único
     config_municipios_js = {}
 
     try:
-        conn = conectar()
-        fase_actual = obtener_fase_actual(conn)
-        fase_anterior = fase_actual - 1
+        plan = None
+        if datos is not None or args.from_snapshot:
+            if datos is None:
+                datos = leer_snapshot(args.from_snapshot)
+                print(f" Datos leídos de la instantánea {args.from_snapshot} (sin BD).")
+            fase_actual = datos["fase"]
+            pendientes, por_conjunto = {m["code"]: forms_pedidos for m in municipios}, None
+        elif args.incremental:
+            conn = conectar()
+            plan = planificar_incremental(conn, municipios, opciones or None)
+            fase_actual = plan["fase"]
+            pendientes, por_conjunto = plan["pendientes"], plan["por_conjunto"]
+            if subconjunto:
+                pendientes = {code: [f for f in forms if f in forms_pedidos] for code, forms in pendientes.items()}
+                pendientes = {code: forms for code, forms in pendientes.items() if forms}
+                por_conjunto = conjuntos_pendientes(pendientes)
+        else:
+            conn = conectar()
+            fase_actual = obtener_fase_actual(conn)
+            pendientes = {m["code"]: forms_pedidos for m in municipios}
+            # Con --mun/--form solo se consultan los conjuntos de esas páginas
+            por_conjunto = conjuntos_pendientes(pendientes) if subconjunto else None
         
-        print(f"Generando formularios para Fase {fase_actual}...")
+        parcial = (plan is not None and not plan["completo"]) or args.shard is not None or subconjunto
+        flags_previas = plan["flags_previas"] if plan is not None and not plan["completo"] else {}
+        ambito = {f"{form}_{code}.html" for code, forms in pendientes.items() for form in forms}
+        if not parcial and datos is None and not args.from_snapshot:
+            # Se leen los equipamientos de todos los municipios: se podan los centroides sobrantes
+            iniciar_poda_visor()
+        miniaturas = None
+        if args.miniaturas:
+            miniaturas = abrir_miniaturas(descargar, args.miniaturas_lado, args.miniaturas_formato, args.miniaturas_caducidad,
+                                          args.miniaturas_refrescar, args.miniaturas_hilos)
         
-        for m in MUNICIPIOS_LISTA_UI:
-            code = m["code"]       # Código del TSV (= código en BD)
-            name_display = m["name_bonito"] 
-            
-            code_bd = code 
-            
-            common_ctx = {
-                "muni_code": code, 
-                "muni_display": name_display,
-                "url_adjuntos": URL_ADJUNTOS,
-                "url_adjuntos_worker": URL_ADJUNTOS_WORKER,
-                "url_generar_pdf": URL_GENERAR_PDF,
-                "url_logger": URL_LOGGER,
-                "fase_anterior": fase_anterior,
-                "fase_actual": fase_actual
-            }
-
-            # --- A) FORMULARIOS ESTÁNDAR (Siempre se generan) ---
-
-            # 1. AGUA
-            depositos = obtener_depositos(conn, code_bd)
-            avisos_agua = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'agua')
-            
-            with open(os.path.join(OUTPUT_DIR, f'agua_{code}.html'), "w", encoding="utf-8") as f:
-                f.write(template_agua.render(
-                    **common_ctx, 
-                    depositos_json=json.dumps(depositos, ensure_ascii=False),
-                    avisos_personalizados=avisos_agua
-                ))
-
-            # 2. OBRAS
-            obras = obtener_obras(conn, code_bd)
-            avisos_obras = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'obras')
-
-            with open(os.path.join(OUTPUT_DIR, f'obras_{code}.html'), "w", encoding="utf-8") as f:
-                f.write(template_obras.render(
-                    **common_ctx, 
-                    obras=obras,
-                    avisos_personalizados=avisos_obras
-                ))
-
-            # 3. RESIDUOS
-            avisos_residuos = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'residuos')
-
-            with open(os.path.join(OUTPUT_DIR, f'residuos_{code}.html'), "w", encoding="utf-8") as f:
-                f.write(template_residuos.render(
-                    **common_ctx,
-                    avisos_personalizados=avisos_residuos
-                ))
-
-
-            # 4. EQUIPAMIENTOS
-            equip_data = obtener_equipamientos(conn, code_bd)
-            avisos_equip = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'equipamientos')
-
-            with open(os.path.join(OUTPUT_DIR, f'equipamientos_{code}.html'), "w", encoding="utf-8") as f:
-                f.write(template_equipamientos.render(
-                    **common_ctx,
-                    equipamientos_agrupados=equip_data,
-                    avisos_personalizados=avisos_equip
-                ))
-            
-            # --- B) FORMULARIOS BAJO DEMANDA (Condicionales) ---
-            # Banderas por defecto para este municipio
-            flag_alumbrado = False
-            flag_viario = False
-            flag_saneamiento = False
-            flag_cementerios = False
-            
-            
-            # 5. CEMENTERIOS
-            cementerios = obtener_cementerios(conn, code_bd)
-            if len(cementerios) > 0:
-                flag_cementerios = True
-                avisos_cementerios = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'cementerios')
-                
-                with open(os.path.join(OUTPUT_DIR, f'cementerios_{code}.html'), "w", encoding="utf-8") as f:
-                    f.write(template_cementerios.render(
-                        **common_ctx, 
-                        cementerios=cementerios, 
-                        cementerios_json=json.dumps(cementerios, ensure_ascii=False),
-                        avisos_personalizados=avisos_cementerios
-                    ))
-
-            # 6. ALUMBRADO
-            avisos_alumbrado = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'alumbrado')
-            if len(avisos_alumbrado) > 0:
-                flag_alumbrado = True
-                with open(os.path.join(OUTPUT_DIR, f'alumbrado_{code}.html'), "w", encoding="utf-8") as f:
-                    f.write(template_alumbrado.render(
-                        **common_ctx,
-                        avisos_personalizados=avisos_alumbrado
-                    ))
-
-            # 7. VIARIO
-            avisos_viario = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'viario')
-            if len(avisos_viario) > 0:
-                flag_viario = True
-                with open(os.path.join(OUTPUT_DIR, f'viario_{code}.html'), "w", encoding="utf-8") as f:
-                    f.write(template_viario.render(
-                        **common_ctx,
-                        avisos_personalizados=avisos_viario
-                    ))
-
-            # 8. SANEAMIENTO
-            avisos_saneamiento = obtener_avisos_personalizados(conn, code_bd, fase_actual, 'saneamiento')
-            if len(avisos_saneamiento) > 0:
-                flag_saneamiento = True
-                with open(os.path.join(OUTPUT_DIR, f'saneamiento_{code}.html'), "w", encoding="utf-8") as f:
-                    f.write(template_saneamiento.render(
-                        **common_ctx,
-                        avisos_personalizados=avisos_saneamiento
-                    ))
-
-            # GUARDAR LAS FLAGS EN EL DICCIONARIO MAESTRO
-            # (El index.html usará esto para mostrar/ocultar botones)
-            config_municipios_js[code] = {
-                'alumbrado': flag_alumbrado,
-                'viario': flag_viario,
-                'saneamiento': flag_saneamiento,
-                'cementerios': flag_cementerios
-            }
+        print(f"Generando formularios para Fase {fase_actual}"
+              + (f" (fragmento {args.shard[0]}/{args.shard[1]}: {len(municipios)} municipios)" if args.shard else "")
+              + (f" con {workers} procesos" if workers > 1 else "") + "...")
+        
+        if args.pipeline:
+            conn.close()
+            conn = None
+            flags = ejecutar_pipeline(salida, municipios, fase_actual, pendientes, por_conjunto,
+                                      workers=workers, conexiones=args.conexiones, lote=args.lote, equip_lazy=equip_lazy,
+                                      miniaturas=miniaturas)
+        elif args.bajo_consumo:
+            flags = renderizar_bajo_consumo(salida, conn, municipios, fase_actual, pendientes, por_conjunto,
+                                            itersize=args.itersize, equip_lazy=equip_lazy, miniaturas=miniaturas)
+            conn.close()
+            conn = None
+        else:
+            if datos is None:
+                # Una consulta por conjunto de datos; el bucle de render ya no toca la BD
+                if por_conjunto is None:
+                    datos = cargar_datos(conn, [m["code"] for m in municipios], fase=fase_actual)
+                else:
+                    datos = cargar_datos(conn, fase=fase_actual, por_conjunto=por_conjunto)
+                conn.close()
+                conn = None
+            if miniaturas is not None:
+                miniaturas_equipamientos(miniaturas, datos["equipamientos"])
+
+            trabajos = [(m, datos_para(datos, m["code"], [form]), [form], equip_lazy)
+                        for m in municipios for form in pendientes.get(m["code"], [])]
+            flags = renderizar_trabajos(salida, trabajos, workers)
+
+        # GUARDAR LAS FLAGS EN EL DICCIONARIO MAESTRO
+        # (El index.html usará esto para mostrar/ocultar botones)
+        for m in municipios:
+            config_municipios_js[m["code"]] = flags_municipio(flags_previas.get(m["code"], {}), flags.get(m["code"], {}))
 
         # --- GENERAR INDEX ÚNICO (Al final del bucle) ---
-        print(f"Generando Index maestro...")
-        with open(os.path.join(OUTPUT_DIR, "index.html"), "w", encoding="utf-8") as f:
-            f.write(template_index.render(
-                fase_actual=fase_actual,
-                municipios_lista=json.dumps(MUNICIPIOS_LISTA_UI, ensure_ascii=False),
-                # Pasamos el mapa de flags al JavaScript del Index
-                config_flags_json=json.dumps(config_municipios_js, ensure_ascii=False), 
-                url_login_api=URL_LOGIN_SCRIPT
-            ))
-            
+        # En modo incremental solo si alguna bandera ha cambiado; por fragmentos, en --merge-index
+        if args.shard is not None:
+            guardar_flags_shard(args.shards_dir, args.shard, fase_actual, config_municipios_js)
+        elif subconjunto:
+            # Se parchean en el index.html publicado solo las banderas de los municipios generados
+            previas = flags_de_index()
+            if previas is None:
+                print(" ⚠️ No se han podido leer las banderas de docs/index.html: no se actualiza.")
+            else:
+                nuevas = dict(previas)
+                for code, f in flags.items():
+                    nuevas[code] = flags_municipio(previas.get(code, {}), f)
+                if nuevas != previas:
+                    print(" Actualizando las banderas de index.html...")
+                    renderizar_index(salida, fase_actual, nuevas)
+                    ambito.add("index.html")
+        elif not parcial or config_municipios_js != flags_previas or not os.path.exists(os.path.join(OUTPUT_DIR, "index.html")):
+            print("Generando Index maestro...")
+            renderizar_index(salida, fase_actual, config_municipios_js)
+            ambito.add("index.html")
+
+        if not parcial:
+            retirar_huellas_antiguas()
+        carpeta_miniaturas = os.path.join(OUTPUT_DIR, *MINIATURAS_SALIDA.split("/"))
+        if miniaturas is not None:
+            publicar_miniaturas(miniaturas, podar=not parcial)
+        elif not parcial and os.path.isdir(carpeta_miniaturas):
+            # Generación completa sin --miniaturas: ninguna página las enlaza ya
+            shutil.rmtree(carpeta_miniaturas)
+            print(f" Retiradas las miniaturas de docs/{MINIATURAS_SALIDA} (generación sin --miniaturas).")
+
+        if parcial:
+            # Los JSON de las páginas regeneradas (--equip-lazy) también entran en la poda
+            ambito.update(n for n in salida["anterior"] if pagina_de_datos(n) in ambito)
+        cambios = cerrar_salida(salida, ambito if parcial else None)
+        if args.precomprimir:
+            precomprimir_salida(salida["actual"])
+        elif not parcial:
+            retirar_precomprimidos()
+        if plan is not None and not subconjunto:
+            # Con un subconjunto el resto de huellas no corresponde a lo que hay en docs/
+            guardar_estado_origen(plan, config_municipios_js)
+        guardar_cache_visor()
+        if presupuesto is not None:
+            cambios["presupuesto"] = comprobar_presupuesto(presupuesto, salida["actual"], time.perf_counter() - inicio)
+            informe_presupuesto(args.presupuesto, cambios["presupuesto"])
+
+        if args.profile:
+            planes = None
+            if args.explain and _perfil["consultas"]:
+                conn = conectar()
+                planes = capturar_explain(conn)
+            informe_perfil(args.profile, time.perf_counter() - inicio, args.profile_top, planes)
         print("\n Proceso finalizado.")
+        return cambios
+    finally:
+        _visor["vistas"] = None
+        if conn: conn.close()
+
+def generar(municipios=None, formularios=None, descargar=descargar_foto, **opciones):
+    """
+    Punto de entrada para usar el generador desde Python, p. ej.
+    generar(["014"], ["agua"]) o generar(workers=4, compactar=True). Las opciones son
+    las de la línea de órdenes con guiones bajos; `descargar` es la descarga de fotos de
+    --miniaturas. Devuelve {"nuevos", "cambiados", "eliminados"}.
+    """
+    args = crear_parser().parse_args([])
+    desconocidas = set(opciones) - set(vars(args))
+    if desconocidas:
+        raise TypeError(f"Opciones desconocidas: {', '.join(sorted(desconocidas))}")
+    vars(args).update(opciones)
+    validar_opciones(args)
+    return ejecutar_generacion(args, municipios, formularios, descargar=descargar)
 
+def generate(municipios=None, forms=None, **opciones):
+    """Igual que generar(), con nombre en inglés: generate(["014"], forms=["equipamientos"])."""
+    return generar(municipios, forms, **opciones)
+
+def main(argv=None, descargar=descargar_foto):
+    parser = crear_parser()
+    args = parser.parse_args(argv)
+    if args.comando == "snapshot":
+        return comando_snapshot(args)
+    if args.comando == "serve":
+        return comando_serve(args)
+    try:
+        validar_opciones(args)
+        validar_seleccion(args.mun, args.form)
+        if args.presupuesto:
+            cargar_presupuesto(args.presupuesto)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    try:
+        if args.watch:
+            return comando_watch(args, args.mun, args.form, descargar)
+        cambios = ejecutar_generacion(args, args.mun, args.form, descargar=descargar)
+        if args.presupuesto_estricto and cambios.get("presupuesto"):
+            return 3
     except Exception as e:
         print(f"\n❌ ERROR CRÍTICO: {e}")
         import traceback; traceback.print_exc()
-    finally:
-        if conn: conn.close()
+        return 1
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,236 @@
+/**
+ * EIEL — equipamientos en diferido (gen_forms.py --equip-lazy)
+ * Fuente: js/eiel-equip-lazy.js → se copia a docs/js/ al regenerar.
+ * Debe cargarse después de js/eiel-forms.js (se cuelga de EIEL.equipLazy).
+ *
+ * Cada <details data-equip-src="data/equipamientos_XXX/<categoria>.json"> llega vacío;
+ * al desplegarlo se descarga su JSON ({campos, filas}) y se pintan las filas por
+ * páginas de data-equip-pagina filas, con el mismo marcado que la plantilla
+ * (mismas clases y data-id), así que el envío las recoge igual que las estáticas.
+ * completar() añade al envío las filas que no se han llegado a pintar.
+ */
+(function (global) {
+    "use strict";
+
+    const ESTADOS = ["Bueno", "Regular", "Malo", "En ejecución"];
+    const cache = new Map();
+
+    function esc(valor) {
+        return String(valor)
+            .replace(/&/g, "&amp;")
+            .replace(/</g, "&lt;")
+            .replace(/>/g, "&gt;")
+            .replace(/"/g, "&#34;")
+            .replace(/'/g, "&#39;");
+    }
+
+    function cargar(details) {
+        const src = details.dataset.equipSrc;
+        if (!cache.has(src)) {
+            const promesa = fetch(src)
+                .then((r) => {
+                    if (!r.ok) throw new Error("HTTP " + r.status + " al cargar " + src);
+                    return r.json();
+                })
+                .then((datos) =>
+                    datos.filas.map((fila) => {
+                        const r = {};
+                        datos.campos.forEach((campo, i) => (r[campo] = fila[i]));
+                        return r;
+                    })
+                );
+            // Si falla, se puede reintentar volviendo a desplegar
+            promesa.catch(() => cache.delete(src));
+            cache.set(src, promesa);
+        }
+        return cache.get(src);
+    }
+
+    function celdaFoto(eq) {
+        // Con miniatura (--miniaturas) la foto completa solo se pide al pulsar
+        const foto = eq.url_foto
+            ? `<img src="${esc(eq.url_miniatura || eq.url_foto)}" data-full="${esc(eq.url_foto)}" class="img-thumb" alt="Foto" loading="lazy"
+                    onclick="abrirVisorImagen(this.dataset.full)"
+                    onerror="this.style.display='none'; this.nextElementSibling.style.display='flex';">
+               <div class="no-photo-placeholder" style="display: none;" title="Error al cargar desde el servidor de mapas. Verifique su conexión o firewall.">
+                   <i data-lucide="camera-off" class="icon-camera-off"></i>
+               </div>`
+            : `<div class="no-photo-placeholder">
+                   <i data-lucide="camera-off" class="icon-camera-off"></i>
+               </div>`;
+        return `
+            <td class="td-foto">
+                <div class="eq-foto-wrap">
+                    ${foto}
+                    <button type="button" class="btn-foto-eq"
+                            onclick="event.stopPropagation(); gestionarFotoEquip('${esc(eq.cod)}')"
+                            title="Subir nueva foto" aria-label="Subir nueva foto">
+                        <i data-lucide="camera" class="icon-sm"></i>
+                    </button>
+                </div>
+                <div id="lista_foto_${esc(eq.cod)}" class="lista-foto-eq"></div>
+            </td>
+            <td class="td-ubicacion">
+                <a href="${esc(eq.url_visor)}" target="_blank" class="btn btn-secondary btn-sm">
+                    <i data-lucide="map-pin"></i><span>Mapa</span>
+                </a>
+            </td>
+            <td>
+                <div class="nombre-eq"><strong>${esc(eq.nombre)}</strong></div> <small class="cod-eq">Cód: ${esc(eq.cod)}</small>
+            </td>`;
+    }
+
+    function filaGeneral(eq) {
+        const punto = eq.estado_txt.toLowerCase().replace(/ /g, "").replace(/ó/g, "o");
+        const opciones = ESTADOS.map(
+            (e) => `<option value="${e}"${eq.estado_txt === e ? " selected" : ""}>${e}</option>`
+        ).join("");
+        const tr = document.createElement("tr");
+        tr.className = "fila-equip";
+        tr.dataset.id = eq.cod;
+        tr.innerHTML = `${celdaFoto(eq)}
+            <td>
+                <div class="estado-wrapper">
+                    <span class="status-dot dot-${esc(punto)}"></span>
+                    <select class="form-select select-estado" data-id="${esc(eq.cod)}" data-original="${esc(eq.estado_txt)}">${opciones}</select>
+                </div>
+            </td>
+            <td>
+                <textarea class="form-input txt-obs-eq" rows="1" placeholder="..."></textarea>
+            </td>`;
+        const select = tr.querySelector(".select-estado");
+        select.addEventListener("change", function () {
+            const dot = this.parentNode.querySelector(".status-dot");
+            if (dot) {
+                dot.className = "status-dot";
+                dot.classList.add("dot-" + this.value.toLowerCase().normalize("NFD").replace(/[\u0300-\u036f]/g, "").replace(/\s/g, ""));
+            }
+        });
+        return tr;
+    }
+
+    function filaSinUso(su) {
+        const tr = document.createElement("tr");
+        tr.className = "fila-sin-uso";
+        tr.dataset.id = su.cod;
+        tr.innerHTML = `${celdaFoto(su)}
+            <td>
+                <div class="uso-container">
+                    <select class="form-select select-sin-uso" data-id="${esc(su.cod)}">
+                        <option value="NO">NO, sigue sin uso</option>
+                        <option value="SI">SÍ, ya tiene uso</option>
+                    </select>
+                    <div class="hidden mt-8px box-uso">
+                        <input type="text" class="form-input txt-nuevo-uso" placeholder="Indique el nuevo uso...">
+                    </div>
+                </div>
+            </td>`;
+        const select = tr.querySelector(".select-sin-uso");
+        const box = tr.querySelector(".box-uso");
+        box.id = "box_uso_" + su.cod;
+        select.addEventListener("change", () => {
+            if (select.value === "SI") box.classList.remove("hidden");
+            else box.classList.add("hidden");
+        });
+        return tr;
+    }
+
+    function marcarSelects(tr) {
+        // Igual que EIEL.setupSelectHasValue() para las filas que llegan después
+        tr.querySelectorAll(".form-select").forEach((select) => {
+            const color = () => select.classList.toggle("has-value", select.value !== "");
+            color();
+            select.addEventListener("change", color);
+        });
+    }
+
+    function pintarPagina(details, filas) {
+        const tbody = details.querySelector("tbody");
+        const pagina = parseInt(details.dataset.equipPagina, 10) || 50;
+        const desde = tbody.children.length;
+        const crear = details.dataset.equipTipo === "sin_uso" ? filaSinUso : filaGeneral;
+        const trozo = document.createDocumentFragment();
+        filas.slice(desde, desde + pagina).forEach((r) => {
+            const tr = crear(r);
+            marcarSelects(tr);
+            trozo.appendChild(tr);
+        });
+        tbody.appendChild(trozo);
+
+        let mas = details.querySelector(".btn-equip-mas");
+        const pintadas = tbody.children.length;
+        if (pintadas < filas.length) {
+            if (!mas) {
+                mas = document.createElement("button");
+                mas.type = "button";
+                mas.className = "btn btn-secondary btn-sm btn-equip-mas mt-1rem";
+                mas.addEventListener("click", () => pintarPagina(details, filas));
+                details.querySelector(".table-wrapper").appendChild(mas);
+            }
+            mas.textContent = `Mostrar más (${pintadas} de ${filas.length})`;
+        } else if (mas) {
+            mas.remove();
+        }
+        if (global.lucide) global.lucide.createIcons();
+    }
+
+    function desplegar(details) {
+        if (details.dataset.equipCargado) return;
+        details.dataset.equipCargado = "1";
+        const aviso = document.createElement("p");
+        aviso.className = "form-help equip-cargando";
+        aviso.textContent = "Cargando…";
+        details.querySelector(".table-wrapper").prepend(aviso);
+        cargar(details)
+            .then((filas) => pintarPagina(details, filas))
+            .catch((error) => {
+                console.error(error);
+                delete details.dataset.equipCargado;
+                details.open = false;
+                if (global.EIEL) global.EIEL.mostrarMensaje("No se han podido cargar los equipamientos. Inténtelo de nuevo.", "error");
+            })
+            .finally(() => aviso.remove());
+    }
+
+    /**
+     * Completa (en el sitio) las listas del envío con las filas no pintadas, en el
+     * orden de la página y con los valores que tendría un formulario sin tocar.
+     */
+    async function completar(datosEquipamientos, datosSinUso) {
+        const porId = new Map(datosEquipamientos.map((d) => [d.id, d]));
+        const porIdSinUso = new Map(datosSinUso.map((d) => [d.id, d]));
+        const equip = [];
+        const sinUso = [];
+        for (const details of document.querySelectorAll("details[data-equip-src]")) {
+            const filas = await cargar(details);
+            const categoria = details.querySelector(".acc-title-box span").textContent;
+            filas.forEach((r) => {
+                if (details.dataset.equipTipo === "sin_uso") {
+                    sinUso.push(porIdSinUso.get(r.cod) || {
+                        id: r.cod, nombre: r.nombre, tiene_uso: "NO", nuevo_uso: "", foto_nueva: ""
+                    });
+                } else {
+                    // Un <select> sin la opción del estado original se queda en la primera ("Bueno")
+                    const estado = ESTADOS.includes(r.estado_txt) ? r.estado_txt : ESTADOS[0];
+                    equip.push(porId.get(r.cod) || {
+                        id: r.cod, nombre: r.nombre, categoria: categoria, estado: estado,
+                        modificado: estado !== r.estado_txt, obs: "", foto_nueva: ""
+                    });
+                }
+            });
+        }
+        datosEquipamientos.splice(0, datosEquipamientos.length, ...equip);
+        datosSinUso.splice(0, datosSinUso.length, ...sinUso);
+    }
+
+    document.addEventListener("DOMContentLoaded", () => {
+        document.querySelectorAll("details[data-equip-src]").forEach((details) => {
+            details.addEventListener("toggle", () => {
+                if (details.open) desplegar(details);
+            });
+        });
+    });
+
+    global.EIEL = global.EIEL || {};
+    global.EIEL.equipLazy = { completar: completar };
+})(window);